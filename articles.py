@@ -0,0 +1,244 @@
+from __future__ import print_function, division
+
+import hashlib
+import json
+import os
+import os.path
+
+import codec
+import util
+from config import config
+
+
+def get_names(word):
+    """Return the (index, articles, manifest) filenames for a word.
+    """
+    return [os.path.join(config.corpus_directory,
+                         config.template[key].format(word))
+            for key in ('index', 'articles', 'manifest')]
+
+
+def load_manifest(name):
+    """Read a manifest file or return None if it is missing or invalid.
+    """
+    try:
+        with open(name, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_manifest(manifest, name):
+    """Atomically replace a manifest file.
+    """
+    tmp_name = name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    util.replace_file(tmp_name, name)
+
+
+def get_suffix():
+    """Return the compression suffix of the articles template, if any.
+    """
+    suffix = os.path.splitext(config.template['articles'])[1]
+    return suffix if suffix in codec.codecs else ''
+
+
+def new_manifest(word, store=None):
+    """Create an empty manifest.
+
+    When store is the root directory of an ArticleStore, article content
+    lives in the store and the manifest only holds references to it.
+    """
+    return dict(word=word, articles=[], skipped=[], chars=0, bytes=0,
+                size=0, checksum=hashlib.sha1().hexdigest(), exhausted=False,
+                store=store, hits=0, hit_bytes=0)
+
+
+def get_checksum(articles):
+    """Combine per-article checksums into a checksum for the whole corpus.
+    """
+    combined = hashlib.sha1()
+    for article in articles:
+        combined.update(article['sha1'].encode('ascii'))
+    return combined.hexdigest()
+
+
+class ArticleStore(object):
+    """Content-addressed store of article text shared by all words.
+
+    Each distinct article is saved once as objects/ab/<sha1><suffix>, where
+    sha1 is the hash of its encoded content and the compression suffix is
+    taken from the articles template when the store is created, and then
+    recorded in store.json. Page titles map to content via small JSON files
+    titles/cd/<sha1 of title>, which also remember titles that are missing
+    or disambiguation pages. All writes are atomic so the store can be
+    shared by concurrent processes.
+    """
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(config.corpus_directory, 'store')
+        self.root = root
+        self.metadata_name = os.path.join(root, 'store.json')
+        try:
+            with open(self.metadata_name, 'r') as f_in:
+                self.suffix = json.load(f_in)['suffix']
+            self.has_metadata = True
+        except (IOError, OSError, ValueError, KeyError):
+            if os.path.isdir(os.path.join(root, 'objects')):
+                # Stores created before store.json always used gzip.
+                self.suffix = '.gz'
+            else:
+                self.suffix = get_suffix()
+            self.has_metadata = False
+
+    def _path(self, kind, key, ext=''):
+        return os.path.join(self.root, kind, key[:2], key + ext)
+
+    def _write(self, name, data):
+        directory = os.path.dirname(name)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process might have just created it.
+                if not os.path.isdir(directory):
+                    raise
+        tmp_name = '{0}.{1}.tmp'.format(name, os.getpid())
+        with codec.open_file(tmp_name, 'wb', like=name) as f_out:
+            f_out.write(data)
+        util.replace_file(tmp_name, name)
+
+    def _title_key(self, title):
+        return hashlib.sha1(title.encode(config.encoding)).hexdigest()
+
+    def lookup(self, title):
+        """Return the stored record for a title or None.
+
+        A record is a dictionary with either sha1, chars and bytes of the
+        article's content, or status for a title that has no content.
+        """
+        name = self._path('titles', self._title_key(title))
+        try:
+            with open(name, 'rb') as f_in:
+                record = json.loads(f_in.read().decode('utf8'))
+        except (IOError, OSError, ValueError):
+            return None
+        # Guard against (very unlikely) title hash collisions.
+        return record if record.get('title') == title else None
+
+    def contains(self, sha1):
+        return os.path.exists(self._path('objects', sha1, self.suffix))
+
+    def get(self, sha1):
+        """Return the encoded content with this sha1.
+        """
+        name = self._path('objects', sha1, self.suffix)
+        with codec.open_file(name, 'rb') as f_in:
+            return f_in.read()
+
+    def put(self, title, content):
+        """Save the content for a title and return its record.
+        """
+        data = content.encode(config.encoding)
+        sha1 = hashlib.sha1(data).hexdigest()
+        if not self.has_metadata:
+            self._write(self.metadata_name, json.dumps(
+                dict(suffix=self.suffix)).encode('utf8'))
+            self.has_metadata = True
+        if not self.contains(sha1):
+            self._write(self._path('objects', sha1, self.suffix), data)
+        record = dict(title=title, sha1=sha1, chars=len(content),
+                      bytes=len(data))
+        self._write(self._path('titles', self._title_key(title)),
+                    json.dumps(record).encode('utf8'))
+        return record
+
+    def put_status(self, title, status):
+        """Remember that a title has no content, e.g. 'disambiguation'.
+        """
+        record = dict(title=title, status=status)
+        self._write(self._path('titles', self._title_key(title)),
+                    json.dumps(record).encode('utf8'))
+        return record
+
+
+def verify(word, manifest, store=None):
+    """Check that a word's article content matches its manifest.
+
+    This reads all of the content so is only used on request.
+    """
+    out_name = get_names(word)[1]
+    if manifest.get('store'):
+        store = store or ArticleStore(manifest['store'])
+        for article in manifest['articles']:
+            try:
+                data = store.get(article['sha1'])
+            except (IOError, OSError):
+                return False
+            if hashlib.sha1(data).hexdigest() != article['sha1']:
+                return False
+    else:
+        with codec.open_file(out_name, 'rb') as f_in:
+            content = f_in.read()
+        offset = 0
+        for article in manifest['articles']:
+            data = content[offset:offset + article['bytes']]
+            if hashlib.sha1(data).hexdigest() != article['sha1']:
+                return False
+            offset += article['bytes']
+        if offset != len(content):
+            return False
+    return get_checksum(manifest['articles']) == manifest['checksum']
+
+
+def exists(word):
+    """Has any article content been fetched for this word?
+    """
+    _, out_name, manifest_name = get_names(word)
+    return os.path.exists(out_name) or os.path.exists(manifest_name)
+
+
+def read_text(word, store=None):
+    """Return all of the article text for a word as a unicode string.
+
+    Content is assembled from the shared store when the word's manifest
+    refers to it, or else read from the word's articles file.
+    """
+    _, out_name, manifest_name = get_names(word)
+    manifest = load_manifest(manifest_name)
+    if manifest is not None and manifest.get('store'):
+        store = store or ArticleStore(manifest['store'])
+        data = b''.join([store.get(article['sha1'])
+                         for article in manifest['articles']])
+    else:
+        with codec.open_file(out_name, 'rb') as f_in:
+            data = f_in.read()
+    return data.decode(config.encoding)
+
+
+def report(words):
+    """Summarize sharing of articles across the manifests of all words.
+    """
+    num_refs, ref_bytes, unique = 0, 0, {}
+    num_hits, hit_bytes, num_words = 0, 0, 0
+    for word in words:
+        manifest = load_manifest(get_names(word)[2])
+        if manifest is None:
+            continue
+        num_words += 1
+        num_hits += manifest.get('hits', 0)
+        hit_bytes += manifest.get('hit_bytes', 0)
+        for article in manifest['articles']:
+            num_refs += 1
+            ref_bytes += article['bytes']
+            unique[article['sha1']] = article['bytes']
+    unique_bytes = sum(unique.values())
+    print('Read manifests for {0} words with {1} article references to {2} '
+          'unique articles (dedup ratio {3:.2f}).'.format(
+              num_words, num_refs, len(unique), num_refs / max(1, len(unique))))
+    print('Referenced {0:.1f} MB of content stored as {1:.1f} MB '
+          '({2:.1f} MB saved).'.format(ref_bytes / 1e6, unique_bytes / 1e6,
+                                       (ref_bytes - unique_bytes) / 1e6))
+    print('Served {0} titles ({1:.1f} MB) from the shared store without '
+          'a request.'.format(num_hits, hit_bytes / 1e6))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import time
+
+import numpy as np
+
+import export
+import util
+from config import config
+
+def get_names(name, size=None):
+    """Return the header filename, or the candidates filename for groups of
+    this size, of the clue tables for an embedding.
+    """
+    if size is None:
+        return name + '.clues.json'
+    return '{0}.clues{1}.npy'.format(name, size)
+
+
+def get_dtype(num_words):
+    """Return the smallest unsigned type for indices into a vocabulary.
+
+    The largest value of the type is reserved to mark the candidates for a
+    group with a word that is not in the vocabulary.
+    """
+    for dtype in (np.uint16, np.uint32):
+        if num_words < np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def get_missing(candidates):
+    return np.iinfo(candidates.dtype).max
+
+
+def exists(name):
+    return os.path.exists(get_names(name))
+
+
+def get_signature(name):
+    """Return a string that changes whenever an embedding is updated.
+    """
+    if export.is_exported(name):
+        with open(export.get_names(name)[0], 'r') as f_in:
+            return json.load(f_in)['checksum']
+    return '{0}:{1:.6f}'.format(os.path.getsize(name), os.path.getmtime(name))
+
+
+def binomial(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def get_groups(num_words, size):
+    """Generate all groups of word indices in increasing order of group_index.
+    """
+    if size == 1:
+        for i in range(num_words):
+            yield (i,)
+        return
+    for last in range(size - 1, num_words):
+        for group in get_groups(last, size - 1):
+            yield group + (last,)
+
+
+def group_index(indices):
+    """Return the row of the clue table for a group of word indices.
+    """
+    return sum([binomial(i, m + 1)
+                for m, i in enumerate(sorted(indices))])
+
+
+# The embedding and vocabulary indices of the words being built, which are
+# shared with worker processes.
+_embedding, _vocab_index = None, None
+
+
+def build_block(args):
+    """Save the candidates for all groups whose largest word index is last.
+    """
+    candidates_name, size, last, k, batch_size = args
+    syn0norm = _embedding.model.syn0norm
+    candidates = np.load(candidates_name, mmap_mode='r+')
+    groups = [group + (last,) for group in get_groups(last, size - 1)]
+    offset = binomial(last, size)
+    for first in range(0, len(groups), batch_size):
+        # Look up the vocabulary indices of the next batch of groups.
+        indices = _vocab_index[np.array(groups[first:first + batch_size])]
+        valid = np.all(indices >= 0, axis=1)
+        rows = np.arange(offset + first, offset + first + len(indices))
+        candidates[rows] = get_missing(candidates)
+        if not np.any(valid):
+            continue
+        # Find the closest words to the normalized mean of each group.
+        # Sum in vocabulary order, the same as get_mean_vector().
+        means = syn0norm[np.sort(indices[valid], axis=1)].mean(axis=1)
+        means /= np.sqrt((means ** 2).sum(axis=1))[:, np.newaxis]
+        closest = _embedding.get_closest(means, k)
+        candidates[rows[valid], :closest.shape[1]] = closest
+    candidates.flush()
+    return len(groups)
+
+
+def build(embedding, name, words, sizes=(2,), k=100, batch_size=256,
+          nproc=None):
+    """Save the top k candidate clues for all groups of words.
+
+    For each group of words from the word list, the candidates are the
+    vocabulary indices with the largest cosine similarity to the mean of
+    the group, in decreasing order, as found by embedding.get_closest().
+    Groups are divided between nproc processes.
+    """
+    global _embedding, _vocab_index
+    header_name = get_names(name)
+    if os.path.exists(header_name):
+        os.remove(header_name)
+    _embedding = embedding
+    _vocab_index = np.array([embedding.model.vocab[word].index
+                             if word in embedding.model.vocab else -1
+                             for word in words])
+
+    for size in sizes:
+        start = time.time()
+        num_groups = binomial(len(words), size)
+        candidates_name = get_names(name, size)
+        np.lib.format.open_memmap(
+            candidates_name + '.tmp', mode='w+',
+            dtype=get_dtype(len(embedding.model.index2word)),
+            shape=(num_groups, k)).flush()
+        tasks = [(candidates_name + '.tmp', size, last, k, batch_size)
+                 for last in range(size - 1, len(words))]
+        pool = multiprocessing.Pool(processes=nproc)
+        num_done = 0
+        for num_block in pool.imap_unordered(build_block, tasks):
+            num_done += num_block
+            print('\rSaved {0}/{1} groups of {2} words ({3:.0f}/s).'.format(
+                num_done, num_groups, size,
+                num_done / (time.time() - start)), end='')
+        pool.close()
+        pool.join()
+        print()
+        util.replace_file(candidates_name + '.tmp', candidates_name)
+        # Remove the similarity scores saved by earlier versions.
+        scores_name = '{0}.clues{1}.scores.npy'.format(name, size)
+        if os.path.exists(scores_name):
+            os.remove(scores_name)
+        print('Saved {0} groups of {1} words in {2:.1f}s ({3:.1f} MB).'.format(
+            num_groups, size, time.time() - start,
+            os.path.getsize(candidates_name) / 1e6))
+
+    header = dict(words=list(words), k=k, sizes=list(sizes),
+                  signature=get_signature(name))
+    tmp_name = header_name + '.tmp'
+    with open(tmp_name, 'w') as f_out:
+        json.dump(header, f_out)
+    util.replace_file(tmp_name, header_name)
+    return header
+
+
+class ClueTable(object):
+    """Memory-mapped tables of the top candidate clues for groups of words.
+    """
+    def __init__(self, name):
+        with open(get_names(name), 'r') as f_in:
+            self.header = json.load(f_in)
+        self.name = name
+        self.k = self.header['k']
+        self.index = dict((word, i)
+                          for i, word in enumerate(self.header['words']))
+        self.candidates = dict(
+            (size, np.load(get_names(name, size), mmap_mode='r'))
+            for size in self.header['sizes'])
+
+    def is_current(self):
+        """Was this table built from the current version of its embedding?
+        """
+        return self.header['signature'] == get_signature(self.name)
+
+    def lookup(self, words, num_search=100):
+        """Return the top candidate clues for a group of words, or None.
+
+        Returns None if the table does not include this group or has fewer
+        than num_search candidates for each group.
+        """
+        if len(words) not in self.candidates or num_search > self.k:
+            return None
+        indices = [self.index.get(word) for word in words]
+        if None in indices or len(set(indices)) < len(indices):
+            return None
+        candidates = self.candidates[len(words)]
+        row = candidates[group_index(indices)]
+        if row[0] == get_missing(candidates):
+            return None
+        return row[:num_search]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Precompute the best clues for groups of words.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type=str, default=config.embedding,
+                        help='Name of the embedding to use.')
+    parser.add_argument('-k', '--num-candidates', type=int, default=100,
+                        help='Number of candidate clues to save per group.')
+    parser.add_argument('--triples', action='store_true',
+                        help='Also save candidates for all groups of three.')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='Number of groups to search at once.')
+    parser.add_argument('--nproc', type=int, default=None,
+                        help='Number of processes (default is one per CPU).')
+    args = parser.parse_args()
+
+    import model
+    embedding = model.WordEmbedding(args.input)
+    with open(config.word_list, 'r') as f:
+        words = [w.strip().lower().replace(' ', '_') for w in f]
+    sizes = (2, 3) if args.triples else (2,)
+    build(embedding, args.input, words, sizes, args.num_candidates,
+          args.batch_size, args.nproc)
+    size = sum([os.path.getsize(get_names(args.input, s)) for s in sizes])
+    print('Saved clue tables for {0} words ({1:.1f} MB).'.format(
+        len(words), size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
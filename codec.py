@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""Compressed file formats for corpus files, selected by filename suffix.
+
+Files ending in .gz, .zst or .lz4 are compressed with gzip, zstd or lz4,
+and any other file is read and written as is.  The zstd and lz4 codecs
+are only available when the zstandard and lz4 packages are installed.
+Compression levels and the number of threads used to compress are set in
+the optional "compression" section of config.json.
+
+All three formats allow a file to consist of several independently
+compressed frames (members, for gzip), so files can be appended to and
+large files are compressed in blocks by a pool of threads.
+"""
+from __future__ import print_function, division
+
+import argparse
+import collections
+import gzip
+import io
+import os
+import os.path
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import metrics
+from config import config
+
+# Default compression options, which can be overridden in config.json.
+options = dict(gzip_level=6, zstd_level=3, lz4_level=0, threads=4,
+               block_size=1 << 20)
+options.update(getattr(config, 'compression', {}))
+
+# Size of the compressed chunks read from a file at once.
+read_size = 1 << 20
+
+
+class GzipCodec(object):
+    name = 'gzip'
+    suffix = '.gz'
+
+    def available(self):
+        return True
+
+    def compressor(self, level):
+        # A wbits value of 16 + 15 writes a gzip header and trailer.
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, level):
+        compressor = self.compressor(level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompressor(self):
+        return zlib.decompressobj(31)
+
+    def finished(self, decompressor):
+        if hasattr(decompressor, 'eof'):
+            return decompressor.eof
+        # Python 2 decompressors have no eof, but any data fed to them after
+        # the end of the stream is left unused.
+        decompressor = decompressor.copy()
+        decompressor.decompress(b'\0')
+        return decompressor.unused_data == b'\0'
+
+
+class ZstdCodec(object):
+    name = 'zstd'
+    suffix = '.zst'
+
+    def available(self):
+        try:
+            import zstandard
+        except ImportError:
+            return False
+        # Reading files with several frames needs zstandard >= 0.16.
+        return hasattr(zstandard.ZstdDecompressor().decompressobj(),
+                       'unused_data')
+
+    def compressor(self, level):
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, level):
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompressor(self):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def finished(self, decompressor):
+        return decompressor.eof
+
+
+class _LZ4Compressor(object):
+    # Give the lz4 frame compressor the same interface as zlib's.
+    def __init__(self, level):
+        import lz4.frame
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b''
+        return header + self.compressor.flush()
+
+
+class LZ4Codec(object):
+    name = 'lz4'
+    suffix = '.lz4'
+
+    def available(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            return False
+        return True
+
+    def compressor(self, level):
+        return _LZ4Compressor(level)
+
+    def compress(self, data, level):
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=level)
+
+    def decompressor(self):
+        import lz4.frame
+        return lz4.frame.LZ4FrameDecompressor()
+
+    def finished(self, decompressor):
+        return decompressor.eof
+
+
+codecs = dict((codec.suffix, codec)
+              for codec in (GzipCodec(), ZstdCodec(), LZ4Codec()))
+
+
+def get_codec(name):
+    """Return the codec for a filename, or None for an uncompressed file.
+    """
+    codec = codecs.get(os.path.splitext(name)[1])
+    if codec is not None and not codec.available():
+        raise IOError('The {0} codec needed for {1} is not installed.'
+                      .format(codec.name, name))
+    return codec
+
+
+def strip_suffix(name):
+    """Remove any compression suffix from a filename.
+    """
+    root, suffix = os.path.splitext(name)
+    return root if suffix in codecs else name
+
+
+_pool, _pool_pid = None, None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the thread pool used for block compression in this process.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(processes=options['threads'])
+            _pool_pid = os.getpid()
+    return _pool
+
+
+class Writer(object):
+    """Compress data written to a binary file object.
+
+    With more than one thread, data is split into blocks that are
+    compressed concurrently as separate frames.  Closing a writer finishes
+    the current frame, so several writers can append to the same file.
+    """
+    def __init__(self, fileobj, codec, level=None, threads=None,
+                 close_fileobj=False):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = (options[codec.name + '_level']
+                      if level is None else level)
+        self.threads = options['threads'] if threads is None else threads
+        self.close_fileobj = close_fileobj
+        self.block_size = options['block_size']
+        self.closed = False
+        self.compressor = None
+        self.buffer, self.buffer_size = [], 0
+        self.pending = collections.deque()
+
+    def write(self, data):
+        if self.threads <= 1:
+            if self.compressor is None:
+                self.compressor = self.codec.compressor(self.level)
+            self._write(self.compressor.compress(data))
+            return
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self._submit()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        metrics.count('bytes_written', len(data))
+
+    def _submit(self):
+        # Compress the buffered data in the thread pool, and write out any
+        # finished blocks in order without queueing too many.
+        data = b''.join(self.buffer)
+        self.buffer, self.buffer_size = [], 0
+        self.pending.append(get_pool().apply_async(
+            self.codec.compress, (data, self.level)))
+        while len(self.pending) > 2 * self.threads:
+            self._write(self.pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+        if self.buffer and not self.pending:
+            # Compress small files without the overhead of the thread pool.
+            self._write(self.codec.compress(b''.join(self.buffer),
+                                            self.level))
+        elif self.buffer:
+            self._submit()
+        while self.pending:
+            self._write(self.pending.popleft().get())
+        if self.close_fileobj:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Reader(object):
+    """Decompress data read from a binary file object.
+
+    Iterating over a reader returns lines with their trailing newline.
+    """
+    def __init__(self, fileobj, codec, close_fileobj=False):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.close_fileobj = close_fileobj
+        self.chunks = self._decompress()
+        self.buffer = b''
+
+    def _decompress(self):
+        decompressor, started = self.codec.decompressor(), False
+        while True:
+            data = self.fileobj.read(read_size)
+            if not data:
+                break
+            metrics.count('bytes_read', len(data))
+            while data:
+                if started and self.codec.finished(decompressor):
+                    decompressor, started = self.codec.decompressor(), False
+                chunk = decompressor.decompress(data)
+                started = True
+                if chunk:
+                    yield chunk
+                # Any data after the end of a frame belongs to the next one.
+                data = decompressor.unused_data
+                if data:
+                    decompressor, started = self.codec.decompressor(), False
+        if started and not self.codec.finished(decompressor):
+            raise IOError('Compressed file ended before the end of a frame.')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.buffer = self.buffer + b''.join(self.chunks), b''
+            return data
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def __iter__(self):
+        tail, self.buffer = self.buffer, b''
+        for chunk in self.chunks:
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if tail:
+            yield tail
+
+    def close(self):
+        if self.close_fileobj:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_file(name, mode='rb', like=None, level=None, threads=None):
+    """Open a file for binary reading, writing or appending.
+
+    The codec is selected by the filename suffix, or by the suffix of like
+    if specified, e.g. when writing to a temporary file.
+    """
+    codec = get_codec(like if like is not None else name)
+    if codec is None:
+        return io.open(name, mode)
+    if mode == 'rb':
+        return Reader(io.open(name, 'rb'), codec, close_fileobj=True)
+    elif mode in ('wb', 'ab'):
+        return Writer(io.open(name, mode), codec, level, threads,
+                      close_fileobj=True)
+    raise ValueError('Invalid mode {0}.'.format(mode))
+
+
+def writer(fileobj, name, level=None, threads=None):
+    """Return a writer that adds a new frame to an open binary file.
+
+    The codec is selected by name, and fileobj is not closed with the writer.
+    """
+    codec = get_codec(name)
+    if codec is None:
+        return Writer(fileobj, _Uncompressed(), level=0, threads=1)
+    return Writer(fileobj, codec, level, threads)
+
+
+class _Uncompressed(object):
+    # Write data as is for files without a compression suffix.
+    name = 'none'
+
+    def compressor(self, level):
+        return self
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class LineSentence(object):
+    """Iterate over the sentences of a (compressed) text corpus.
+
+    This is equivalent to gensim's LineSentence, but supports every codec.
+    Each line is one sentence of words separated by whitespace, and longer
+    sentences are split into chunks of max_sentence_length words.
+    """
+    def __init__(self, source, max_sentence_length=10000):
+        self.source = source
+        self.max_sentence_length = max_sentence_length
+
+    def __iter__(self):
+        with open_file(self.source, 'rb') as f_in:
+            for line in f_in:
+                words = line.decode(config.encoding).split()
+                for i in range(0, len(words), self.max_sentence_length):
+                    yield words[i:i + self.max_sentence_length]
+
+
+def benchmark(name, threads):
+    """Compare the size and speed of each available codec on a file.
+    """
+    with open_file(name, 'rb') as f_in:
+        data = f_in.read()
+    print('Read {0:.1f} MB from {1}.'.format(len(data) / 1e6, name))
+    trials = [('gzip module', GzipCodec(), 9, 1)]
+    for level in (1, 6, 9):
+        trials.append(('gzip', GzipCodec(), level, 1))
+        trials.append(('gzip', GzipCodec(), level, threads))
+    for codec, levels in ((ZstdCodec(), (1, 3, 9)), (LZ4Codec(), (0, 9))):
+        if not codec.available():
+            print('The {0} codec is not installed.'.format(codec.name))
+            continue
+        for level in levels:
+            trials.append((codec.name, codec, level, 1))
+            trials.append((codec.name, codec, level, threads))
+
+    print('      CODEC LEVEL THREADS  RATIO  WRITE(MB/s)  READ(MB/s)')
+    # Write in blocks of a typical size for the other scripts.
+    block = 1 << 16
+    handle, tmp_name = tempfile.mkstemp(suffix='.tmp')
+    os.close(handle)
+    try:
+        for label, codec, level, num_threads in trials:
+            start = time.time()
+            if label == 'gzip module':
+                # The original gzip.open() usage, for comparison.
+                with gzip.open(tmp_name, 'wb') as f_out:
+                    f_out.write(data)
+            else:
+                with io.open(tmp_name, 'wb') as f_raw:
+                    with Writer(f_raw, codec, level, num_threads) as f_out:
+                        for i in range(0, len(data), block):
+                            f_out.write(data[i:i + block])
+            write_time = time.time() - start
+            size = os.path.getsize(tmp_name)
+            start = time.time()
+            if label == 'gzip module':
+                with gzip.open(tmp_name, 'rb') as f_in:
+                    num_lines = sum(1 for _ in f_in)
+            else:
+                with io.open(tmp_name, 'rb') as f_raw:
+                    num_lines = sum(1 for _ in Reader(f_raw, codec))
+            read_time = time.time() - start
+            assert num_lines == data.count(b'\n') + (
+                not data.endswith(b'\n') and len(data) > 0)
+            print('{0:>11s} {1:5d} {2:7d} {3:6.2f} {4:12.1f} {5:11.1f}'.format(
+                label, level, num_threads, len(data) / size,
+                len(data) / write_time / 1e6, len(data) / read_time / 1e6))
+    finally:
+        os.remove(tmp_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recompress or benchmark corpus files.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input', type=str,
+                        help='Name of the file to read.')
+    parser.add_argument('output', type=str, nargs='?', default=None,
+                        help='Name of the file to write, using the codec for '
+                        'its suffix.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare the size and speed of each codec.')
+    parser.add_argument('--threads', type=int, default=options['threads'],
+                        help='Number of threads used for compression.')
+    args = parser.parse_args()
+    options['threads'] = args.threads
+
+    if args.output is not None:
+        start = time.time()
+        with open_file(args.input, 'rb') as f_in:
+            with open_file(args.output, 'wb', threads=args.threads) as f_out:
+                for chunk in iter(lambda: f_in.read(read_size), b''):
+                    f_out.write(chunk)
+        print('Wrote {0} ({1:.1f} MB) in {2:.1f}s.'.format(
+            args.output, os.path.getsize(args.output) / 1e6,
+            time.time() - start))
+    if args.benchmark:
+        benchmark(args.input, args.threads)
+
+
+if __name__ == '__main__':
+    main()
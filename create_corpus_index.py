@@ -3,55 +3,255 @@
 from __future__ import print_function, division
 
 import argparse
+import collections
 import io
+import json
+import multiprocessing
 import os
 import os.path
+import time
 from functools import partial
 
+import metrics
+import util
+import wikisite
 from config import config
 
 # Maximum number of wikipedia articles to index per word. Can be
 # overridden using the --max-size command-line argument.
 max_index_size = 10000
 
+# Save the crawl state after this many new pages have been indexed.
+checkpoint_interval = 250
 
-def ingest(page, page_titles, depth=0, max_depth=1):
-
-    title = page.title()
-    if title in page_titles:
-        return page_titles
-    # Must be in one of the following namespaces:
-    # Main, Category, Portal, Book.
-    # https://en.wikipedia.org/wiki/Wikipedia:Namespace
-    if page.namespace() not in (0, 14, 100, 108,):
-        return page_titles
-    page_titles.add(title)
-    # Have we reached our target number of pages?
-    if len(page_titles) >= max_index_size:
-        raise StopIteration
-    # Explore children of this page?
-    if depth >= max_depth:
-        return page_titles
-    # Visit pages linked from this page.
-    for sub_page in page.linkedPages(total=max_index_size // 3):
-        ingest(sub_page, page_titles, depth + 1, max_depth)
-    # Visit pages that refer to or embed this page.
-    for sub_page in page.getReferences(total=max_index_size // 3):
-        ingest(sub_page, page_titles, depth + 1, max_depth)
-
-    return page_titles
+# Number of times to retry a failed request before giving up on a word,
+# and the initial delay in seconds between retries (doubled each time).
+max_retries = 8
+retry_delay = 5.
+
+# Options used to create the site in each worker process, and the site
+# used by this process, created on first use.
+site_options = dict(cache=None, ttl=30 * 86400., fake_site=None)
+_site = None
+
+
+def get_site():
+    global _site
+    if _site is None:
+        if site_options['fake_site']:
+            _site = wikisite.FakeSite.load(site_options['fake_site'])
+        else:
+            # Use the english wikipedia.
+            _site = wikisite.WikiSite('en', 'wikipedia')
+        if site_options['cache']:
+            # Share page metadata with all other words and processes.
+            cache = wikisite.PageCache(site_options['cache'],
+                                       ttl=site_options['ttl'])
+            _site = wikisite.CachedSite(_site, cache)
+    return _site
+
+
+def load_checkpoint(name):
+    """Read a saved crawl state or return None.
+    """
+    try:
+        with open(name, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_checkpoint(state, name):
+    """Atomically replace a saved crawl state.
+    """
+    tmp_name = name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(state, f)
+    util.replace_file(tmp_name, name)
+
+
+def expand(task, site, titles, index_size, max_depth=1):
+    """Process one frontier task without changing any crawl state.
+
+    Returns a tuple (title, children) where title is a new page title to
+    index (or None) and children is a list of new tasks to explore next,
+    in order.
+    """
+    kind = task[0]
+    if kind == 'page':
+        _, title, depth = task
+        title, namespace = site.normalize(title)
+        if title in titles:
+            return None, []
+        # Must be in one of the following namespaces:
+        # Main, Category, Portal, Book.
+        # https://en.wikipedia.org/wiki/Wikipedia:Namespace
+        if namespace not in (0, 14, 100, 108,):
+            return None, []
+        # Explore children of this page?
+        if depth >= max_depth or len(titles) + 1 >= index_size:
+            return title, []
+        children = []
+        # Visit pages linked from this page.
+        for sub_title in site.linked(title, total=index_size // 3):
+            children.append(['page', sub_title, depth + 1])
+        # Visit pages that refer to or embed this page.
+        for sub_title in site.references(title, total=index_size // 3):
+            children.append(['page', sub_title, depth + 1])
+        return title, children
+    elif kind == 'disambig':
+        # Try to ingest a disambiguation page for this word.
+        word = task[1]
+        if site.is_disambig(word):
+            return None, []
+        return None, [['page', word + ' (disambiguation)', 0]]
+    elif kind == 'search':
+        # Try to ingest the results of a site-wide search for this word.
+        word = task[1]
+        return None, [['page', title, 1]
+                      for title in site.search(word, total=index_size)]
+    raise ValueError('Invalid crawl task {0}.'.format(task))
+
+
+def crawl(word, checkpoint_name, index_size=max_index_size):
+    """Crawl pages related to word and return their titles.
+
+    The crawl visits the page for this word, its disambiguation page and
+    the results of a site-wide search, and the pages linked to and from
+    each of these, in depth-first order.  The visited titles and the
+    frontier of pages still to visit are saved to checkpoint_name
+    periodically so that an interrupted crawl can resume where it left
+    off.  Requests that fail with a transient error are retried with
+    exponential backoff, and other failed tasks, e.g. for an invalid or
+    missing page, are skipped.
+    """
+    site = get_site()
+
+    state = load_checkpoint(checkpoint_name)
+    if state is None:
+        state = dict(word=word, titles=[], frontier=[
+            ['page', word, 0], ['disambig', word], ['search', word]])
+    else:
+        print('Resuming crawl for {0} with {1} pages indexed.'
+              .format(word, len(state['titles'])))
+    titles = set(state['titles'])
+    frontier = collections.deque(state['frontier'])
+
+    def checkpoint():
+        state['frontier'] = list(frontier)
+        save_checkpoint(state, checkpoint_name)
+
+    last_checkpoint = len(titles)
+    attempt = 0
+    while frontier and len(titles) < index_size:
+        try:
+            title, children = expand(frontier[0], site, titles, index_size)
+        except site.TransientError as e:
+            attempt += 1
+            checkpoint()
+            if attempt > max_retries:
+                raise
+            delay = retry_delay * 2 ** (attempt - 1)
+            print('Retrying {0} for {1} in {2:.0f}s after error:: {3}'
+                  .format(frontier[0], word, delay, e))
+            time.sleep(delay)
+            continue
+        except site.Error as e:
+            # Retrying will not help, so move on to the next task.
+            print('Skipping {0} for {1} after error:: {2}'
+                  .format(frontier.popleft(), word, e))
+            attempt = 0
+            continue
+        attempt = 0
+        # Replace this task with its children at the front of the frontier
+        # so that pages are explored in depth-first order.
+        frontier.popleft()
+        frontier.extendleft(reversed(children))
+        if title is not None:
+            titles.add(title)
+            state['titles'].append(title)
+        if len(titles) - last_checkpoint >= checkpoint_interval:
+            checkpoint()
+            last_checkpoint = len(titles)
+
+    return state['titles']
+
+
+def index_word(word, index_size=max_index_size):
+    """Create the index file for one word, if necessary.
+
+    Returns a message describing what was done and the number of page
+    cache hits and misses while crawling this word.
+    """
+    with metrics.measure('index', word) as measured:
+        message, hits, misses = _index_word(word, index_size, measured)
+        measured.update(hits=hits, misses=misses)
+    return message, hits, misses
+
+
+def _index_word(word, index_size, measured):
+    out_name = os.path.join(config.corpus_directory, config.template['index'].format(word))
+    checkpoint_name = os.path.join(config.corpus_directory, config.template['crawl'].format(word))
+
+    if os.path.isfile(out_name):
+        with io.open(out_name, 'r', encoding=config.encoding) as existing:
+            lines = sum(chunk.count('\n')
+                        for chunk in iter(partial(existing.read, 2**16), ''))
+        measured.update(skipped=True, pages=lines)
+        return ('File {0} already exists ({1} lines), skipping it.'
+                .format(out_name, lines)), 0, 0
+
+    cache = getattr(get_site(), 'cache', None)
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    try:
+        page_titles = crawl(word, checkpoint_name, index_size)
+    except Exception as e:
+        message = 'Unable to index {0}, rerun to resume:: {1}'.format(word, e)
+        measured.update(error=str(e))
+    else:
+        # Save the set of all ingested page names for this word.
+        tmp_name = out_name + '.tmp'
+        with io.open(tmp_name, 'w', encoding=config.encoding) as out:
+            for title in page_titles:
+                out.write(title + '\n')
+        os.rename(tmp_name, out_name)
+        if os.path.exists(checkpoint_name):
+            os.remove(checkpoint_name)
+        message = ('Saved index of {0} pages to {1}.'
+                   .format(len(page_titles), out_name))
+        measured.update(pages=len(page_titles))
+    if cache:
+        hits, misses = cache.hits - hits, cache.misses - misses
+        message += ' Cache hit rate {0:.1%} ({1} of {2}).'.format(
+            hits / max(1, hits + misses), hits, hits + misses)
+    return message, hits, misses
 
 
 def main():
-    global max_index_size
     parser = argparse.ArgumentParser(
         description='Create an index for the training corpus.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--index-size', type=int, default=max_index_size,
                         help='Target number of pages per word.')
+    parser.add_argument('--nproc', type=int, default=4,
+                        help='Number of words to crawl concurrently.')
+    parser.add_argument('--cache', type=str,
+                        default=os.path.join(config.corpus_directory, 'pages.db'),
+                        help='Page metadata cache shared by all words.')
+    parser.add_argument('--cache-days', type=float, default=30.,
+                        help='Number of days before cached metadata expires.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use the page metadata cache.')
+    parser.add_argument('--fake-site', type=str, default=None,
+                        help='Crawl a fake site read from this JSON file.')
+    parser.add_argument('--report', type=str,
+                        default=metrics.get_report_name('index'),
+                        help='Append timings of this run to this report.')
     args = parser.parse_args()
 
-    max_index_size = args.index_size
+    site_options.update(
+        cache=None if args.no_cache else args.cache,
+        ttl=args.cache_days * 86400., fake_site=args.fake_site)
 
     # Read the word list into memory and format using wikimedia conventions.
     # https://en.wikipedia.org/wiki/Wikipedia:Naming_conventions_(capitalization)
@@ -62,49 +262,23 @@ def main():
     if not os.path.isdir(config.corpus_directory):
         os.mkdir(config.corpus_directory)
 
-    # Use the english wikipedia with no user config and ignore warnings.
-    os.environ['PYWIKIBOT2_NO_USER_CONFIG'] = '2'
-    import pywikibot
-    site = pywikibot.Site('en', 'wikipedia')
-
-    for word in words:
-        out_name = os.path.join(config.corpus_directory, config.template['index'].format(word))
-
-        if os.path.isfile(out_name):
-            with io.open(out_name, 'r', encoding=config.encoding) as existing:
-                lines = sum(chunk.count('\n')
-                            for chunk in iter(partial(existing.read, 2**16), ''))
-            print('File {0} already exists ({1} lines), skipping it.'
-                  .format(out_name, lines))
-        else:
-            page_titles = set()
-            try:
-                # Try to ingest the page for this word directly.
-                page = pywikibot.Page(site, word)
-                page_titles = ingest(page, page_titles)
-
-                # Try to ingest a disambiguation page for this word.
-                if not page.isDisambig():
-                    page = pywikibot.Page(site, word + ' (disambiguation)')
-                    page_titles = ingest(page, page_titles)
-
-                # Try to ingest the results of a site-wide search for this word.
-                # Only include results in the Main namespace.
-                results = site.search(
-                    searchstring=word, where='text', namespaces=[0])
-                for page in results:
-                    page_titles = ingest(page, page_titles, depth=1)
-            except StopIteration:
-                # We normally get here once 10,000 pages have been ingested.
-                pass
-
-            # Save the set of all ingested page names for this word.
-            with io.open(out_name, 'w', encoding=config.encoding) as out:
-                for title in page_titles:
-                    out.write(title + '\n')
-
-            print('Saved index of {0} pages to {1}.'
-                  .format(len(page_titles), out_name))
+    metrics.open_report(args.report, 'create_corpus_index',
+                        dict(index=len(words)), index_size=args.index_size,
+                        nproc=args.nproc)
+    total_hits, total_misses = 0, 0
+    pool = multiprocessing.Pool(processes=args.nproc)
+    for message, hits, misses in pool.imap_unordered(
+            partial(index_word, index_size=args.index_size), words):
+        print(message)
+        total_hits += hits
+        total_misses += misses
+    pool.close()
+    pool.join()
+    metrics.close_report(hits=total_hits, misses=total_misses)
+    if total_hits + total_misses > 0:
+        print('Page cache hit rate {0:.1%} ({1} of {2} lookups).'.format(
+            total_hits / (total_hits + total_misses), total_hits,
+            total_hits + total_misses))
 
 if __name__ == '__main__':
     main()
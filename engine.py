@@ -5,6 +5,7 @@ import re
 import sys
 import os
 import platform
+import time
 
 import numpy as np
 
@@ -14,37 +15,60 @@ from config import config
 CLUE_PATTERN = r'^([a-zA-Z]+) ({0})$'
 UNLIMITED = "unlimited"
 
+# Smaller boards do not have room for both players, the assassin and at
+# least one bystander.
+min_board_size = 3
+
 
 # noinspection PyAttributeOutsideInit
 class GameEngine(object):
 
-    def __init__(self, seed=None, expert=False):
-
-        # Load our word list if necessary.
-        # TODO: Max length of 11 is hardcoded here and in print_board()
-        with open(config.word_list) as f:
-            _words = [line.rstrip().lower().replace(' ', '_') for line in f.readlines()]
-        self.words = np.array(_words, dtype='S11')
+    def __init__(self, seed=None, expert=False, word_list=None,
+                 beam_width=64):
 
         # Initialize our word embedding model if necessary.
         self.model = model.WordEmbedding(config.embedding)
 
+        # Load our word list if necessary, and ignore any words that we
+        # cannot give clues for.
+        with open(word_list or config.word_list) as f:
+            _words = [line.rstrip().lower().replace(' ', '_') for line in f.readlines()]
+        _words = [word for word in _words if word]
+        known = [word for word in _words if word in self.model.model.vocab]
+        if len(known) < len(_words):
+            say('Ignoring {0} words that are not in the embedding.'
+                .format(len(_words) - len(known)))
+        if len(known) < min_board_size ** 2:
+            raise ValueError(
+                'Only {0} words in {1} are in the embedding, but a board '
+                'needs at least {2}.'.format(
+                    len(known), word_list or config.word_list,
+                    min_board_size ** 2))
+        self.words = np.array(known)
+        self.word_width = max([len(word) for word in known])
+
         # Initialize random numbers.
         self.generator = np.random.RandomState(seed=seed)
 
         # Register expert mode
         self.expert = expert
-        self.unfound_words = (set(), set())
+
+        # Number of groups of each size for the computer spymaster to try
+        # when there are too many to try them all.
+        self.beam_width = beam_width
 
         # Useful regular expressions.
         if self.expert:
-            self.valid_clue = re.compile(CLUE_PATTERN.format("[0-9]|" + UNLIMITED))
+            self.valid_clue = re.compile(CLUE_PATTERN.format("[0-9]+|" + UNLIMITED))
         else:
-            self.valid_clue = re.compile(CLUE_PATTERN.format("[0-9]"))
+            self.valid_clue = re.compile(CLUE_PATTERN.format("[0-9]+"))
 
     def initialize_random_game(self, size=5):
 
         self.size = size
+        if size * size > len(self.words):
+            raise ValueError('Not enough words for a {0}x{0} board ({1} < {2}).'
+                             .format(size, len(self.words), size * size))
 
         # Shuffle the wordlist.
         shuffle = self.generator.choice(
@@ -52,17 +76,16 @@ class GameEngine(object):
         self.board = self.words[shuffle]
 
         # Specify the layout for this game.
+        first, second = get_layout(size)
         assignments = self.generator.permutation(size * size)
         self.owner = np.empty(size * size, int)
         self.owner[assignments[0]] = 0  # assassin
-        self.owner[assignments[1:10]] = 1  # first player: 9 words
-        self.owner[assignments[10:18]] = 2  # second player: 8 words
-        self.owner[assignments[18:]] = 3  # bystander: 7 words
-
-        self.assassin_word = self.board[self.owner == 0]
+        self.owner[assignments[1:first + 1]] = 1  # first player
+        self.owner[assignments[first + 1:first + second + 1]] = 2  # second player
+        self.owner[assignments[first + second + 1:]] = 3  # bystanders
 
         # All cards are initially visible.
-        self.visible = np.ones_like(self.owner, dtype=bool)
+        self.index_board(np.ones_like(self.owner, dtype=bool))
 
         self.num_turns = -1
 
@@ -105,17 +128,50 @@ class GameEngine(object):
 
         self.board = np.array(board)
         self.owner = np.array(owner)
-        self.visible = np.array(visible)
+        visible = np.array(visible)
 
         # Perform a random shuffle of the board.
         shuffle = self.generator.permutation(size * size)
         self.board = self.board[shuffle]
         self.owner = self.owner[shuffle]
-        self.visible = self.visible[shuffle]
+        self.index_board(visible[shuffle])
 
-        self.assassin_word = self.board[self.owner == 0]
         self.num_turns = -1
 
+    def index_board(self, visible):
+        """Save the board state in the form used while playing.
+
+        The vocabulary indices, positions and owner bitmasks of the board
+        words are found once per game, so that each turn only needs integer
+        operations.  Bit i of each mask is set for board position i.
+        """
+        self.indices = self.get_board_indices(self.board, self.owner, visible)
+        self.position = dict((word, i) for i, word
+                             in enumerate(self.board.tolist()) if visible[i])
+        self.owner_masks = [get_mask(self.owner == owner)
+                            for owner in range(4)]
+        self.visible_mask = get_mask(visible)
+        # Remember the words of previous clues that each team has not found.
+        self.unfound_masks = [0, 0]
+
+    @property
+    def visible(self):
+        """Array of which board words are still visible.
+        """
+        return np.array([bool(self.visible_mask >> i & 1)
+                         for i in range(len(self.board))])
+
+    def get_board_indices(self, board, owner, visible):
+        """Return the vocabulary indices of board words, or -1 if hidden.
+
+        Hidden words are only looked up for the assassin, which is always
+        a veto word.
+        """
+        used = visible | (owner == 0)
+        indices = -np.ones(len(board), dtype=np.int64)
+        indices[used] = self.model.get_indices(board[used])
+        return indices
+
     def print_board(self, spymaster=False, clear_screen=True):
 
         if clear_screen:
@@ -133,46 +189,176 @@ class GameEngine(object):
                 word = board[row, col]
                 tag = '#<>-'[owner[row, col]]
                 if not visible[row, col]:
-                    word = tag * 11
+                    word = tag * self.word_width
                 elif not spymaster:
                     tag = ' '
                 if not spymaster or owner[row, col] in (0, 1, 2):
                     word = word.upper()
-                sys.stdout.write('{0}{1:11s} '.format(tag, word))
+                sys.stdout.write('{0}{1:{2}s} '.format(
+                    tag, word, self.word_width))
             sys.stdout.write('\n')
 
+    def get_state(self):
+        """Return a copy of the current board state for use with get_clues().
+        """
+        return dict(board=self.board.copy(), owner=self.owner.copy(),
+                    visible=self.visible, indices=self.indices.copy(),
+                    player=getattr(self, 'player', 0))
+
+    def get_board_words(self, state):
+        """Return the vocabulary indices of the (player, negative, veto)
+        words of a board state.
+        """
+        owner, visible = state['owner'], state['visible']
+        indices = state.get('indices')
+        if indices is None:
+            indices = self.get_board_indices(state['board'], owner, visible)
+        player = state.get('player', 0)
+        player_words = indices[(owner == player + 1) & visible]
+        opponent_words = indices[(owner == 2 - player) & visible]
+        neutral_words = indices[(owner == 3) & visible]
+        neg_words = np.concatenate((opponent_words, neutral_words))
+        veto_words = indices[owner == 0]
+        return player_words, neg_words, veto_words
+
+    def get_groups(self, player_words, beam_width=64, max_exhaustive=9):
+        """Return (count, words, key) for the groups of player words to try.
+
+        All groups are returned when there are at most max_exhaustive player
+        words.  Otherwise, the number of groups grows exponentially, so they
+        are found with get_beam() instead.  The key is the sorted tuple of
+        words (or indices), which identifies the same group on any board.
+        """
+        num_words = len(player_words)
+        if num_words <= max_exhaustive:
+            # Loop over all permutations of words.
+            subsets = [group for count in range(num_words, 0, -1)
+                       for group in itertools.combinations(
+                           range(num_words), count)]
+        else:
+            subsets = self.get_beam(player_words, beam_width)
+        groups = []
+        for group in subsets:
+            words = player_words[list(group)]
+            groups.append((len(group), words, tuple(sorted(words.tolist()))))
+        return groups
+
+    def get_beam(self, player_words, beam_width=64):
+        """Find the most similar groups of player words with a beam search.
+
+        Groups start from every single word and grow one word at a time,
+        keeping only the beam_width groups of each size whose least similar
+        pair of words has the largest cosine similarity, since these are the
+        groups that a clue is most likely to cover.  Returns tuples of
+        positions in player_words, for at most beam_width * num_words groups.
+        """
+        vectors = self.model.model.syn0norm[self.model.get_indices(
+            player_words)]
+        cosines = np.dot(vectors, vectors.T)
+        num_words = len(player_words)
+        # Each group in the beam has its score and the smallest cosine of
+        # each word with any word in the group.
+        beam = [((i,), 1., cosines[i]) for i in range(num_words)]
+        subsets = [group for group, _, _ in beam]
+        for count in range(2, num_words + 1):
+            candidates = {}
+            for group, score, min_cosines in beam:
+                for i, min_cosine in enumerate(min_cosines.tolist()):
+                    if i in group:
+                        continue
+                    key = tuple(sorted(group + (i,)))
+                    if key not in candidates:
+                        candidates[key] = (
+                            min(score, min_cosine), min_cosines, i)
+            best = sorted(candidates, key=lambda key: (
+                -candidates[key][0], key))[:beam_width]
+            beam = []
+            for key in best:
+                score, min_cosines, i = candidates[key]
+                beam.append((key, score, np.minimum(min_cosines, cosines[i])))
+            subsets.extend(best)
+        # List the largest groups first, as for all groups.
+        return sorted(subsets, key=len, reverse=True)
+
+    def get_clues(self, states, gamma=1.0, num_clues=10, veto_margin=0.2,
+                  num_search=100, batch_size=64, max_cache=200000,
+                  beam_width=None, max_exhaustive=9):
+        """Find the best clues for many boards at once.
+
+        Each state is a dictionary with the board words, their owners, which
+        words are still visible, the player (0 or 1) giving the clue and
+        optionally the vocabulary indices of the words, as returned by
+        get_state().  Returns a list of the top num_clues (score, clue, words)
+        for each state, in decreasing order of score, and saves timing
+        statistics in batch_stats.
+
+        The groups of player words to try are found by get_groups() with
+        beam_width (by default the engine's) and max_exhaustive.  The closest
+        vocabulary words to each group are looked up in the embedding's clue
+        tables when possible, or else found for batch_size groups at a time,
+        and are reused by any other board with the same group.
+        """
+        if beam_width is None:
+            beam_width = self.beam_width
+        start = time.time()
+        closest, results = {}, []
+        num_groups, num_unique = 0, 0
+        for state in states:
+            player_words, neg_words, veto_words = self.get_board_words(state)
+            groups = self.get_groups(player_words, beam_width, max_exhaustive)
+            num_groups += len(groups)
+
+            # Find the closest words for any groups we have not seen yet.
+            if len(closest) > max_cache:
+                closest.clear()
+            new_keys = sorted(set([key for _, _, key in groups
+                                   if key not in closest]))
+            num_unique += len(new_keys)
+            closest.update(zip(new_keys, self.model.get_group_closest(
+                new_keys, num_search, batch_size)))
+
+            best_score, saved_clues, legal = [], [], {}
+            for count, words, key in groups:
+                # Multiply similarity scores by this factor for any clue
+                # corresponding to this many words.
+                bonus_factor = count ** gamma
+                clue, score = self.model.select_clue(
+                    clue_words=words, pos_words=player_words,
+                    neg_words=neg_words, veto_words=veto_words,
+                    closest=closest[key], veto_margin=veto_margin,
+                    legal=legal)
+                if clue:
+                    best_score.append(score * bonus_factor)
+                    saved_clues.append((clue, words))
+            order = sorted(range(len(saved_clues)),
+                           key=lambda k: best_score[k], reverse=True)
+            results.append([
+                (best_score[i], saved_clues[i][0],
+                 self.model.get_words(saved_clues[i][1]))
+                for i in order[:num_clues]])
+
+        elapsed = time.time() - start
+        self.batch_stats = dict(
+            num_boards=len(states), num_groups=num_groups,
+            num_unique_groups=num_unique, elapsed=elapsed,
+            boards_per_sec=len(states) / elapsed if elapsed > 0 else 0.)
+        return results
+
     def play_computer_spymaster(self, gamma=1.0, verbose=True):
 
         say('Thinking...')
         sys.stdout.flush()
 
-        # Loop over all permutations of words.
-        num_words = len(self.player_words)
-        best_score, saved_clues = [], []
-        for count in range(num_words, 0, -1):
-            # Multiply similarity scores by this factor for any clue
-            # corresponding to this many words.
-            bonus_factor = count ** gamma
-            for group in itertools.combinations(range(num_words), count):
-                words = self.player_words[list(group)]
-                clue, score = self.model.get_clue(clue_words=words,
-                                                  pos_words=self.player_words,
-                                                  neg_words=np.concatenate((self.opponent_words, self.neutral_words)),
-                                                  veto_words=self.assassin_word)
-                if clue:
-                    best_score.append(score * bonus_factor)
-                    saved_clues.append((clue, words))
-        num_clues = len(saved_clues)
-        order = sorted(xrange(num_clues), key=lambda k: best_score[k], reverse=True)
+        clues = self.get_clues([self.get_state()], gamma=gamma)[0]
 
         if verbose:
             self.print_board(spymaster=True)
-            for i in order[:10]:
-                clue, words = saved_clues[i]
-                say(u'{0:.3f} {1} = {2}'.format(best_score[i], ' + '.join([w.upper() for w in words]), clue))
+            for score, clue, words in clues:
+                say(u'{0:.3f} {1} = {2}'.format(score, ' + '.join([w.upper() for w in words]), clue))
 
-        clue, words = saved_clues[order[0]]
-        self.unfound_words[self.player].update(words)
+        score, clue, words = clues[0]
+        for word in words:
+            self.unfound_masks[self.player] |= 1 << self.position[word]
         if self.expert and self._should_say_unlimited(nb_clue_words=len(words)):
             return clue, UNLIMITED
         else:
@@ -186,10 +372,9 @@ class GameEngine(object):
         (3) but all the words hinted by the current and previous clues
             are enough to catch up and win
         """
-        return (len(self.opponent_words) <= threshold_opponent  # (1)
-                and nb_clue_words + 1 < len(self.player_words)  # (2)
-                and self.unfound_words[self.player]
-                                    == set(self.player_words))  # (3)
+        return (count_bits(self.opponent_mask) <= threshold_opponent  # (1)
+                and nb_clue_words + 1 < count_bits(self.player_mask)  # (2)
+                and self.unfound_masks[self.player] == self.player_mask)  # (3)
 
     def play_human_spymaster(self):
 
@@ -219,26 +404,27 @@ class GameEngine(object):
                 if guess == '':
                     # Team does not want to make any more guesses.
                     return True
-                if guess in self.board[self.visible]:
-                    break
+                if guess in self.position:
+                    bit = 1 << self.position[guess]
+                    if self.visible_mask & bit:
+                        break
                 say('Invalid guess, should be a visible word.')
 
-            loc = np.where(self.board == guess)[0]
-            self.visible[loc] = False
+            self.visible_mask &= ~bit
 
-            if guess == self.assassin_word:
+            if self.owner_masks[0] & bit:
                 say('{0} You guessed the assasin - game over!'.format(self.player_label))
                 return False
 
-            if guess in self.player_words:
-                self.unfound_words[self.player].discard(guess)
-                if num_guesses == len(self.player_words):
+            if self.player_mask & bit:
+                self.unfound_masks[self.player] &= ~bit
+                if num_guesses == count_bits(self.player_mask):
                     say('{0} You won!!!'.format(self.player_label))
                     return False
                 else:
                     ask('{0} Congratulations, keep going! (hit ENTER)\n'.format(self.player_label))
             else:
-                if guess in self.opponent_words:
+                if self.opponent_mask & bit:
                     ask('{0} Sorry, word from opposing team! (hit ENTER)\n'.format(self.player_label))
                 else:
                     ask('{0} Sorry, bystander! (hit ENTER)\n'.format(self.player_label))
@@ -253,9 +439,8 @@ class GameEngine(object):
         self.opponent = (self.player + 1) % 2
 
         self.player_label = '<>'[self.player] * 3
-        self.player_words = self.board[(self.owner == self.player + 1) & self.visible]
-        self.opponent_words = self.board[(self.owner == self.opponent + 1) & self.visible]
-        self.neutral_words = self.board[(self.owner == 3) & self.visible]
+        self.player_mask = self.owner_masks[self.player + 1] & self.visible_mask
+        self.opponent_mask = self.owner_masks[self.opponent + 1] & self.visible_mask
 
     def play_turn(self, spymaster='human', team='human'):
 
@@ -274,18 +459,43 @@ class GameEngine(object):
         return ongoing
 
     def play_game(self, spymaster1='human', team1='human',
-                  spymaster2='human', team2='human', init=None):
+                  spymaster2='human', team2='human', init=None, size=5):
 
         if init is None:
-            self.initialize_random_game()
+            self.initialize_random_game(size)
         else:
-            self.initialize_from_words(init)
+            self.initialize_from_words(init, size)
 
         while True:
             if not self.play_turn(spymaster1, team1): break
             if not self.play_turn(spymaster2, team2): break
 
 
+def get_layout(size):
+    """Return the number of (first, second) player words on a board.
+
+    These are 9 and 8 on the standard 5x5 board, and scale with the board
+    area otherwise.  The board also has a single assassin, and the remaining
+    words are bystanders.  Raises ValueError for boards smaller than
+    min_board_size.
+    """
+    if size < min_board_size:
+        raise ValueError('Boards must be at least {0}x{0}.'
+                         .format(min_board_size))
+    first = (size * size * 9 + 12) // 25
+    return first, first - 1
+
+
+def get_mask(flags):
+    """Return a bitmask with bit i set when flags[i] is true.
+    """
+    return sum([1 << i for i, flag in enumerate(flags) if flag])
+
+
+def count_bits(mask):
+    return bin(mask).count('1')
+
+
 def say(message):
     sys.stdout.write((message + '\n').encode('utf8'))
 
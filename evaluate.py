@@ -5,10 +5,232 @@ from __future__ import print_function, division
 import argparse
 import glob
 import os
+import time
 
+import numpy as np
+
+import clue_table
+import export
 import model
+import util
 from config import config
 
+# The kinds of groups that can be evaluated and their sizes.
+group_sizes = (('singles', 1), ('pairs', 2))
+
+
+def get_passes():
+    """Return the numbers of all saved or exported passes, in increasing order.
+    """
+    all_suffixes = set()
+    for f in glob.glob('{0}.*'.format(config.embedding)):
+        if f.endswith('.json'):
+            # Look for the header of an exported pass.
+            f = f[:-len('.json')]
+        all_suffixes.add(f.split('.')[-1])
+    return sorted([int(s) for s in all_suffixes if s.isdigit()])
+
+
+def score_groups(embedding, words, groups, num_search=100, batch_size=64,
+                 legal=None):
+    """Find the best clue for groups of words with no other words around.
+
+    Gives the same results as get_clue(group, group, [], []) for each group
+    of indices into words, but scores batch_size groups at a time.  Returns
+    the scores (NaN when there is no legal clue) and clues.  Calls can share
+    a legal dictionary to remember which clues are legal for each word.
+    """
+    syn0norm, vocab = embedding.model.syn0norm, embedding.model.vocab
+    index2word = embedding.model.index2word
+    if legal is None:
+        legal = {}
+    scores = np.empty(len(groups), dtype=np.float32)
+    scores[:] = np.nan
+    clues = [u''] * len(groups)
+    for first in range(0, len(groups), batch_size):
+        batch = [[words[i] for i in group]
+                 for group in groups[first:first + batch_size]]
+        closest = np.array(embedding.get_group_closest(
+            batch, num_search, batch_size))
+        indices = np.array([[vocab[word].index for word in group]
+                            for group in batch])
+        # Calculate the smallest cosine of each candidate with its group.
+        cosines = np.einsum('gkd,gsd->gks', syn0norm[closest],
+                            syn0norm[indices]).min(axis=2)
+        # Only check the legality of candidates in decreasing order of
+        # their score, with ties in reverse order since select_clue() keeps
+        # the last of equal scores.
+        num_candidates = closest.shape[1]
+        order = num_candidates - 1 - np.argsort(
+            -cosines[:, ::-1], axis=1, kind='mergesort')
+        for j, group in enumerate(batch):
+            for k in order[j].tolist():
+                clue = index2word[closest[j, k]]
+                # A clue is legal for a group if it is legal for each word.
+                for word in group:
+                    if (clue, word) not in legal:
+                        legal[clue, word] = embedding.is_legal(clue, [word])
+                if all([legal[clue, word] for word in group]):
+                    scores[first + j] = cosines[j, k]
+                    clues[first + j] = clue
+                    break
+    return scores, clues
+
+
+def evaluate_checkpoints(names, words, output, kinds=('singles',),
+                         num_search=100, batch_size=64, bins=50):
+    """Evaluate several checkpoints and save all results to one file.
+
+    The output has one row per checkpoint and one column per group of words
+    for the score and clue of each kind of group, and the histograms of the
+    scores.  Results are reused from an existing output for checkpoints
+    whose vectors have not changed, so only new checkpoints or words are
+    evaluated.
+    """
+    results = dict(checkpoints=np.array(names), num_search=num_search,
+                   words=np.array(words), bins=np.linspace(0., 1., bins + 1))
+    results['signatures'] = np.array(
+        [clue_table.get_signature(name) for name in names])
+    groups = dict((kind, list(clue_table.get_groups(len(words), size)))
+                  for kind, size in group_sizes if kind in kinds)
+
+    # Find the previous results for each checkpoint and group of words.
+    old_rows, old_columns = {}, {}
+    if os.path.exists(output):
+        old = np.load(output)
+        if int(old['num_search']) == num_search:
+            old_rows = dict((signature, row) for row, signature
+                            in enumerate(old['signatures'].tolist()))
+            for kind in groups:
+                if kind + '_groups' not in old.files:
+                    continue
+                old_words = old['words'].tolist()
+                old_columns[kind] = dict(
+                    (tuple([old_words[i] for i in group]), column)
+                    for column, group in enumerate(old[kind + '_groups']))
+
+    # Remember which clues are legal, and the stems of words, across all
+    # checkpoints, since these do not depend on the vectors.
+    legal, stems = {}, {}
+    for kind in groups:
+        num_groups = len(groups[kind])
+        results[kind + '_groups'] = np.array(groups[kind], dtype=np.int32)
+        results[kind + '_score'] = np.empty((len(names), num_groups),
+                                            dtype=np.float32)
+        results[kind + '_clue'] = np.empty((len(names), num_groups),
+                                           dtype=object)
+        results[kind + '_hist'] = np.empty((len(names), bins), dtype=np.int64)
+    for row, name in enumerate(names):
+        start = time.time()
+        embedding = None
+        old_row = old_rows.get(results['signatures'][row])
+        num_evaluated = 0
+        for kind in groups:
+            scores = results[kind + '_score'][row]
+            clues = results[kind + '_clue'][row]
+            missing = range(len(groups[kind]))
+            if old_row is not None and kind in old_columns:
+                columns = [old_columns[kind].get(tuple(
+                    [words[i] for i in group])) for group in groups[kind]]
+                missing = [i for i, column in enumerate(columns)
+                           if column is None]
+                found = [i for i, column in enumerate(columns)
+                         if column is not None]
+                columns = [columns[i] for i in found]
+                scores[found] = old[kind + '_score'][old_row, columns]
+                clues[found] = old[kind + '_clue'][old_row, columns]
+            if missing:
+                if embedding is None:
+                    embedding = model.WordEmbedding(name)
+                    embedding.stems = stems
+                scores[missing], clues[missing] = score_groups(
+                    embedding, words, [groups[kind][i] for i in missing],
+                    num_search, batch_size, legal)
+            num_evaluated += len(missing)
+            results[kind + '_hist'][row] = np.histogram(
+                scores[~np.isnan(scores)], bins=results['bins'])[0]
+        print('Evaluated {0} new groups for {1} in {2:.1f}s.'.format(
+            num_evaluated, name, time.time() - start))
+        del embedding
+
+    for kind in groups:
+        results[kind + '_clue'] = results[kind + '_clue'].astype('U')
+    tmp_name = output + '.tmp'
+    with open(tmp_name, 'wb') as f_out:
+        np.savez_compressed(f_out, **results)
+    util.replace_file(tmp_name, output)
+    return results
+
+
+def evaluate_all(args, plt=None):
+    """Evaluate several checkpoints for main().
+    """
+    names = [checkpoint if not checkpoint.isdigit() else
+             '{0}.{1}'.format(config.embedding, checkpoint)
+             for checkpoint in args.checkpoints]
+    if not names:
+        names = ['{0}.{1}'.format(config.embedding, npass)
+                 for npass in get_passes()]
+    if not names:
+        print('No checkpoints of {0} found.'.format(config.embedding))
+        return
+    for name in names:
+        if export.is_exported(name):
+            continue
+        if not os.path.isfile(name):
+            print('Embedding file {0} not found.'.format(name))
+            return
+        # Export the vectors so they can be memory mapped.
+        print('Exporting {0}...'.format(name))
+        export.export(export.load_full(name), name)
+
+    with open(config.word_list, 'r') as f:
+        words = [w.strip().lower().replace(' ', '_') for w in f]
+    kinds = [kind for kind, top in (('singles', args.top_singles),
+                                    ('pairs', args.top_pairs)) if top > 0]
+    results = evaluate_checkpoints(names, words, args.output, kinds,
+                                   args.num_search, args.batch_size)
+
+    print('{0:>20s}'.format('CHECKPOINT') + ''.join(
+        ['{0:>9s} MEAN  MEDIAN'.format(kind.upper()) for kind in kinds]))
+    for row, name in enumerate(names):
+        line = '{0:>20s}'.format(name)
+        for kind in kinds:
+            scores = results[kind + '_score'][row]
+            scores = scores[~np.isnan(scores)]
+            line += '{0:14.3f} {1:7.3f}'.format(
+                np.mean(scores), np.median(scores))
+        print(line)
+
+    for kind, top in (('singles', args.top_singles),
+                      ('pairs', args.top_pairs)):
+        if kind not in kinds:
+            continue
+        for row, name in enumerate(names):
+            print('Top {0} for {1}:'.format(kind, name))
+            scores = np.nan_to_num(results[kind + '_score'][row])
+            for column in np.argsort(-scores, kind='mergesort')[:top]:
+                # List the words of each group in the order used above.
+                group = results[kind + '_groups'][column][::-1]
+                print(u'{0:.3f} {1} = {2}'.format(
+                    scores[column], ' + '.join(
+                        [words[i].upper() for i in group]),
+                    results[kind + '_clue'][row, column]))
+        if plt is not None:
+            bins = results['bins']
+            for row, name in enumerate(names):
+                plt.hist(bins[:-1], bins=bins,
+                         weights=results[kind + '_hist'][row],
+                         histtype='step', label=name)
+            plt.xlim(0., 1.)
+            plt.xlabel('Similarity Score')
+            plt.ylabel(kind.capitalize())
+            plt.yscale('log')
+            plt.legend(loc='upper left')
+            plt.grid()
+            plt.savefig(args.save_plots + '_{0}.png'.format(kind))
+            plt.clf()
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -24,6 +246,15 @@ def main():
                         help='Show top pair matches.')
     parser.add_argument('--save-plots', type=str, default=None,
                         help='Save plots using this filename root.')
+    parser.add_argument('--checkpoints', type=str, nargs='*', default=None,
+                        help='Evaluate these pass numbers or embedding names '
+                        'together (all passes if none are listed).')
+    parser.add_argument('--output', type=str, default='evaluation.npz',
+                        help='Save the results for all checkpoints here.')
+    parser.add_argument('--num-search', type=int, default=100,
+                        help='Number of candidate clues for each group.')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='Number of groups to score at once.')
     args = parser.parse_args()
 
     if args.save_plots:
@@ -32,17 +263,20 @@ def main():
         matplotlib.use('Agg')
         import matplotlib.pyplot as plt
 
+    if args.checkpoints is not None:
+        evaluate_all(args, plt if args.save_plots else None)
+        return
+
     if args.npass is not None:
         evaluated_file = '{0}.{1}'.format(config.embedding, args.npass)
-    elif os.path.isfile(config.embedding):
+    elif (os.path.isfile(config.embedding) or
+          export.is_exported(config.embedding)):
         evaluated_file = config.embedding
     else:
-        all_suffixes = [f.split('.')[-1]
-                        for f in glob.glob('{0}.*'.format(config.embedding))]
-        evaluated_file = '{0}.{1}'.format(config.embedding,
-                                          sorted(all_suffixes)[-1])
+        evaluated_file = '{0}.{1}'.format(config.embedding, get_passes()[-1])
 
-    if not os.path.isfile(evaluated_file):
+    if not (os.path.isfile(evaluated_file) or
+            export.is_exported(evaluated_file)):
         print('Embedding file {0} not found.'.format(evaluated_file))
 
     embedding = model.WordEmbedding(evaluated_file)
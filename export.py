@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import collections
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import os.path
+import time
+import warnings
+
+import numpy as np
+
+import util
+from config import config
+
+# Identifies the compact embedding format and its version, which should be
+# incremented for any incompatible change.
+format_name = 'codenames-embedding'
+format_version = 1
+
+Vocab = collections.namedtuple('Vocab', ('index', 'count'))
+
+
+def get_names(name):
+    """Return the (header, vectors, vocab) filenames for an exported embedding.
+    """
+    return name + '.json', name + '.vectors.npy', name + '.vocab'
+
+
+def is_exported(name):
+    """Has an embedding been exported with this name?
+    """
+    return os.path.exists(get_names(name)[0])
+
+
+def file_checksum(name, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(name, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_checksum(name):
+    """Return the combined checksum of the vectors and vocab files.
+    """
+    _, vectors_name, vocab_name = get_names(name)
+    return hashlib.sha1('{0} {1}'.format(
+        file_checksum(vectors_name), file_checksum(vocab_name)).encode(
+            'utf8')).hexdigest()
+
+
+def export(model, name):
+    """Save only what is needed to play from a trained gensim model.
+
+    Writes the normalized word vectors as float32, and the vocabulary words
+    with their counts in index order.  The header is written last, so an
+    interrupted export is never loaded.
+    """
+    header_name, vectors_name, vocab_name = get_names(name)
+    if os.path.exists(header_name):
+        os.remove(header_name)
+    model.init_sims()
+    vectors = np.asarray(model.syn0norm, dtype=np.float32)
+    np.save(vectors_name, vectors)
+    with io.open(vocab_name, 'w', encoding=config.encoding) as f_out:
+        for word in model.index2word:
+            f_out.write(u'{0} {1}\n'.format(word, model.vocab[word].count))
+    header = dict(
+        format=format_name, version=format_version,
+        num_words=len(model.index2word), vector_size=vectors.shape[1],
+        dtype=vectors.dtype.str, checksum=get_checksum(name))
+    tmp_name = header_name + '.tmp'
+    with open(tmp_name, 'w') as f_out:
+        json.dump(header, f_out, indent=1, sort_keys=True)
+    util.replace_file(tmp_name, header_name)
+    return header
+
+
+class CompactModel(object):
+    """Exported word vectors with the attributes of a gensim model used to play.
+
+    The vectors are memory mapped unless mmap is False, and are checked
+    against the saved checksum if verify is True.
+    """
+    def __init__(self, name, mmap=True, verify=False):
+        header_name, vectors_name, vocab_name = get_names(name)
+        with open(header_name, 'r') as f_in:
+            self.header = json.load(f_in)
+        if self.header.get('format') != format_name:
+            raise ValueError('{0} is not an exported embedding.'
+                             .format(header_name))
+        if self.header.get('version') != format_version:
+            raise ValueError('{0} has unsupported version {1}.'.format(
+                header_name, self.header.get('version')))
+        if verify and get_checksum(name) != self.header['checksum']:
+            raise ValueError('Checksum does not match for {0}.'.format(name))
+
+        self.syn0norm = np.load(vectors_name, mmap_mode='r' if mmap else None)
+        self.index2word, self.vocab = [], {}
+        with io.open(vocab_name, 'r', encoding=config.encoding) as f_in:
+            for index, line in enumerate(f_in):
+                word, count = line.rsplit(' ', 1)
+                self.index2word.append(word)
+                self.vocab[word] = Vocab(index, int(count))
+        num_words, self.vector_size = self.syn0norm.shape
+        if (num_words != self.header['num_words'] or
+                num_words != len(self.index2word) or
+                self.vector_size != self.header['vector_size']):
+            raise ValueError('Inconsistent sizes for {0}.'.format(name))
+
+    def similarity(self, word1, word2):
+        return float(np.dot(self.syn0norm[self.vocab[word1].index],
+                            self.syn0norm[self.vocab[word2].index]))
+
+
+def load_full(name):
+    """Load a gensim checkpoint the way play did before exports.
+    """
+    # Import gensim here so we can mute a UserWarning about the Pattern
+    # library not being installed.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        import gensim.models.word2vec
+    model = gensim.models.word2vec.Word2Vec.load(name)
+    model.init_sims(replace=True)
+    return model
+
+
+def get_rss():
+    """Return the resident memory of this process in MB, if known.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f_in:
+            num_pages = int(f_in.read().split()[1])
+        return num_pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def measure_load(args):
+    """Load an embedding in a worker process and return (seconds, MB RSS).
+    """
+    kind, name = args
+    rss_start = get_rss()
+    start = time.time()
+    if kind == 'full':
+        model = load_full(name)
+    else:
+        model = CompactModel(name)
+    # Look up every vector once, as playing or evaluating eventually does.
+    model.syn0norm.sum()
+    elapsed = time.time() - start
+    rss = get_rss()
+    return elapsed, None if rss is None else rss - rss_start
+
+
+def disk_size(names):
+    return sum([os.path.getsize(name) for name in names
+                if os.path.exists(name)]) / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export a trained embedding for playing.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input', type=str, nargs='?', default=None,
+                        help='Name of the trained model to export, e.g. {0}.5'
+                        .format(config.embedding))
+    parser.add_argument('-o', '--output', type=str, default=config.embedding,
+                        help='Name of the exported embedding.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check an existing export against its checksum.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare loading the full and exported models.')
+    args = parser.parse_args()
+    if args.input is None and not args.verify:
+        parser.error('The model to export is required without --verify.')
+
+    if args.verify:
+        CompactModel(args.output, verify=True)
+        print('Checksum OK for {0}.'.format(args.output))
+    else:
+        start = time.time()
+        header = export(load_full(args.input), args.output)
+        print('Exported {0} words of dimension {1} to {2}.* in {3:.1f}s.'
+              .format(header['num_words'], header['vector_size'],
+                      args.output, time.time() - start))
+
+    if args.compare and args.input is not None:
+        full_names = [args.input] + [
+            '{0}.{1}.npy'.format(args.input, weights)
+            for weights in ('syn0', 'syn1', 'syn1neg')]
+        print('    MODEL  DISK(MB)  LOAD(s)  RSS(MB)')
+        for kind, name, names in (('full', args.input, full_names),
+                                  ('compact', args.output,
+                                   get_names(args.output))):
+            # Load each model in a fresh process so memory use is comparable.
+            pool = multiprocessing.Pool(processes=1)
+            elapsed, rss = pool.apply(measure_load, ((kind, name),))
+            pool.close()
+            pool.join()
+            print('{0:>9s} {1:9.1f} {2:8.2f} {3:>8s}'.format(
+                kind, disk_size(names), elapsed,
+                'n/a' if rss is None else '{0:.1f}'.format(rss)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,89 +2,282 @@
 from __future__ import print_function, division
 
 import argparse
-import gzip
+import hashlib
 import io
 import multiprocessing
 import os
 import os.path
 import random
 import warnings
+from functools import partial
 
-import wikipedia
-
+import articles
+import codec
+import fetcher
+import metrics
 from config import config
 
 dry_run = False
 
+# Options used to create the article fetcher in each worker process.
+fetcher_options = {}
+_fetcher = None
+
+# Root of the shared article store, or None to write each word's articles
+# to its own file.
+store_root = None
+
+# Number of characters to accumulate before closing the current frame
+# and updating the manifest. Anything fetched since the last checkpoint is
+# lost if the process is interrupted.
+checkpoint_size = 250000
+
+
+def get_fetcher():
+    """Return the article fetcher for this process, creating it if necessary.
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = fetcher.ArticleFetcher(**fetcher_options)
+    return _fetcher
+
+
+def check_legacy(out_name, min_size):
+    """Check an articles file that was written without a manifest.
+
+    Returns the file's size in characters if it is complete or None.
+    """
+    try:
+        # Check the compressed structure and size.
+        with codec.open_file(out_name, 'rb') as f_in:
+            # Uncompress the whole file into memory.  This is relatively
+            # expensive, but is the only foolproof check without a manifest.
+            content = f_in.read().decode(config.encoding)
+            size = len(content)
+            if size >= min_size:
+                return size
+            print('Good file "{0}" below minimum size: {1} < {2}.'
+                  .format(out_name, size, min_size))
+    except Exception as e:
+        print('Bad file "{0}":: {1}'.format(out_name, e))
+    return None
+
+
+def fetch_to_file(manifest, manifest_name, out_name, titles, min_size):
+    """Append articles for titles to out_name until we reach min_size.
+
+    Returns the number of articles added.
+    """
+    num_articles = 0
+    num_errors = 0
+    with open(out_name, 'r+b') as f_raw:
+        # Drop any partial frame left by an interrupted run.
+        f_raw.truncate(manifest['size'])
+        f_raw.seek(0, os.SEEK_END)
+
+        pending, pending_skipped = [], []
+        f_out = None
+
+        def checkpoint():
+            # Close the current frame and record its articles.
+            if f_out is not None:
+                f_out.close()
+                f_raw.flush()
+            manifest['articles'].extend(pending)
+            manifest['skipped'].extend(pending_skipped)
+            manifest['chars'] += sum(a['chars'] for a in pending)
+            manifest['bytes'] += sum(a['bytes'] for a in pending)
+            manifest['size'] = f_raw.tell()
+            manifest['checksum'] = articles.get_checksum(manifest['articles'])
+            articles.save_manifest(manifest, manifest_name)
+            del pending[:]
+            del pending_skipped[:]
+
+        for page_title, content, error in get_fetcher().fetch(titles):
+            if error in fetcher.no_content:
+                # Ignore missing, disambiguation and empty pages.
+                pending_skipped.append(page_title)
+                continue
+            elif error is not None:
+                print('Unable to fetch "{0}":: {1}'.format(page_title, error))
+                num_errors += 1
+                continue
+            # Save this article's content in a new frame if necessary.
+            data = content.encode(config.encoding)
+            if f_out is None:
+                f_out = codec.writer(f_raw, out_name)
+            f_out.write(data)
+            pending.append(dict(title=page_title, chars=len(content),
+                                bytes=len(data),
+                                sha1=hashlib.sha1(data).hexdigest()))
+            num_articles += 1
+            pending_chars = sum(a['chars'] for a in pending)
+            if manifest['chars'] + pending_chars >= min_size:
+                break
+            if pending_chars >= checkpoint_size:
+                checkpoint()
+                f_out = None
+        else:
+            # Every title has been tried. Only mark this word as exhausted
+            # if there were no errors that a later run might recover from.
+            manifest['exhausted'] = num_errors == 0
+        checkpoint()
 
-def fetch(word, min_size=5e6):
+    return num_articles
 
+
+def fetch_to_store(manifest, manifest_name, titles, min_size):
+    """Add references to articles for titles until we reach min_size.
+
+    Articles already in the shared store are used without any request.
+    Returns the number of articles added.
+    """
+    store = articles.ArticleStore(store_root)
+    num_articles = 0
+    num_errors = 0
+    pending_chars = 0
+    batch_size = fetcher.max_titles_per_query
+    for first in range(0, len(titles), batch_size):
+        batch = titles[first:first + batch_size]
+        # Look up each title in the store and fetch any we don't have.
+        records = dict((title, store.lookup(title)) for title in batch)
+        needed = [title for title in batch if records[title] is None]
+        # Fetch lazily so that we stop requesting articles soon after
+        # reaching min_size.
+        fetched = get_fetcher().fetch(needed)
+        # Add references in our reproducible random order.
+        for page_title in batch:
+            record = records[page_title]
+            if record is None:
+                # Fetched titles are generated in the same order.
+                _, content, error = next(fetched)
+                if error in fetcher.no_content:
+                    record = store.put_status(page_title, error)
+                elif error is not None:
+                    print('Unable to fetch "{0}":: {1}'
+                          .format(page_title, error))
+                    num_errors += 1
+                    continue
+                else:
+                    record = store.put(page_title, content)
+            else:
+                # This title was resolved without any request.
+                manifest['hits'] += 1
+                manifest['hit_bytes'] += record.get('bytes', 0)
+            if 'status' in record:
+                manifest['skipped'].append(page_title)
+                continue
+            manifest['articles'].append(record)
+            manifest['chars'] += record['chars']
+            manifest['bytes'] += record['bytes']
+            pending_chars += record['chars']
+            num_articles += 1
+            if manifest['chars'] >= min_size:
+                break
+        manifest['checksum'] = articles.get_checksum(manifest['articles'])
+        if manifest['chars'] >= min_size:
+            break
+        if pending_chars >= checkpoint_size:
+            articles.save_manifest(manifest, manifest_name)
+            pending_chars = 0
+    else:
+        # Every title has been tried. Only mark this word as exhausted
+        # if there were no errors that a later run might recover from.
+        manifest['exhausted'] = num_errors == 0
+    articles.save_manifest(manifest, manifest_name)
+
+    return num_articles
+
+
+def fetch(word, min_size=5e6, verify=False):
+    """Fetch the articles for one word, if necessary.
+
+    Returns the word, its number of indexed pages, the number of articles
+    added and the total number of characters fetched.
+    """
+    with metrics.measure('fetch', word) as measured:
+        result = _fetch(word, min_size, verify, measured)
+        _, num_pages, num_articles, chars = result
+        measured.update(pages=num_pages, articles=num_articles, chars=chars)
+    return result
+
+
+def _fetch(word, min_size, verify, measured):
     # Use a reproducible but different "random" shuffle for each word.
     random.seed(word)
 
-    in_name = os.path.join(config.corpus_directory, config.template['index'].format(word))
-    out_name = os.path.join(config.corpus_directory, config.template['articles'].format(word))
+    in_name, out_name, manifest_name = articles.get_names(word)
 
     # Has this word already been fetched?
-    if os.path.exists(out_name):
-        try:
-            # Check the GZIP structure and size.
-            with gzip.open(out_name, 'rb') as f_in:
-                # Uncompress the whole file into memory.  This is relatively
-                # expensive, but is the only foolproof check.
-                content = f_in.read().decode(config.encoding)
-                size = len(content)
-                if size >= min_size:
-                    return word, 0, 0, size
-                print('Good file "{0}" below minimum size: {1} < {2}.'
-                      .format(out_name, size, min_size))
-        except Exception as e:
-            print('Bad file "{0}":: {1}'.format(out_name, e))
+    manifest = articles.load_manifest(manifest_name)
+    if manifest is not None:
+        if manifest.get('store'):
+            file_size = 0
+        elif os.path.exists(out_name):
+            file_size = os.path.getsize(out_name)
+        else:
+            file_size = -1
+        if file_size < manifest['size']:
+            print('Articles file "{0}" shorter than its manifest.'.format(out_name))
+            manifest = None
+        elif verify and not articles.verify(word, manifest):
+            print('Articles for {0} do not match their manifest.'.format(word))
+            manifest = None
+        elif manifest['chars'] >= min_size or manifest['exhausted']:
+            measured.update(skipped=True)
+            return word, 0, 0, manifest['chars']
+    elif os.path.exists(out_name):
+        size = check_legacy(out_name, min_size)
+        if size is not None:
+            measured.update(skipped=True)
+            return word, 0, 0, size
+
+    if manifest is None:
+        # Start again from scratch, but leave any existing files unchanged
+        # in a dry run.
+        manifest = articles.new_manifest(word, store=store_root)
+        if manifest['store'] and not dry_run:
+            if os.path.exists(out_name):
+                os.remove(out_name)
+        elif not dry_run:
+            with open(out_name, 'wb'):
+                pass
 
     with io.open(in_name, 'r', encoding=config.encoding) as f_in:
         # Read all page titles.
         page_titles = [line.rstrip() for line in f_in]
-        # Generate a random order of page titles.
-        order = range(len(page_titles))
-        random.shuffle(order)
-        print('Fetching from {0} pages for {1}.'.format(len(page_titles), word))
-
-        if dry_run:
-            return word, 0, 0, 0
-
-        total_size = 0
-        num_articles = 0
-        with gzip.open(out_name, 'wb') as f_out:
-
-            for article_index in order:
-                page_title = page_titles[article_index]
-                # Read this article's plain-text content.
-                with warnings.catch_warnings():
-                    # Ignore warnings.  The expected warnings are:
-                    # requests.packages.urllib3.exceptions.SubjectAltNameWarning
-                    # UserWarning
-                    warnings.simplefilter('ignore')
-                    try:
-                        page = wikipedia.page(
-                            page_title, auto_suggest=False, preload=False)
-                        content = page.content
-                        # Save this article's content.
-                        f_out.write(content.encode(config.encoding))
-                        total_size += len(content)
-                        num_articles += 1
-                        if total_size >= min_size:
-                            break
-                    except wikipedia.exceptions.DisambiguationError:
-                        # Ignore disambiguation pages.
-                        pass
-                    except Exception as e:
-                        print('Unexpected Error:: {0}'.format(e))
-
-    return word, len(page_titles), num_articles, total_size
+    # Generate a random order of page titles.
+    order = range(len(page_titles))
+    random.shuffle(order)
+    # Skip any titles that we have already processed.
+    done = set(article['title'] for article in manifest['articles'])
+    done.update(manifest['skipped'])
+    remaining = [page_titles[i] for i in order if page_titles[i] not in done]
+    print('Fetching from {0} pages for {1} ({2} already done).'
+          .format(len(page_titles), word, len(done)))
+
+    if dry_run:
+        return word, 0, 0, 0
+
+    with warnings.catch_warnings():
+        # Ignore warnings.  The expected warnings are:
+        # requests.packages.urllib3.exceptions.SubjectAltNameWarning
+        # UserWarning
+        warnings.simplefilter('ignore')
+        if manifest['store']:
+            num_articles = fetch_to_store(
+                manifest, manifest_name, remaining, min_size)
+        else:
+            num_articles = fetch_to_file(
+                manifest, manifest_name, out_name, remaining, min_size)
+    if manifest['chars'] < min_size and not manifest['exhausted']:
+        measured.update(error='Incomplete after failed requests.')
+
+    return word, len(page_titles), num_articles, manifest['chars']
 
 
 def main():
-    global dry_run
+    global dry_run, store_root
     parser = argparse.ArgumentParser(
         description='Fetch indexed training corpus text.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -92,8 +285,30 @@ def main():
                         help='Number of processing pool workers to use.')
     parser.add_argument('--dry-run', action='store_true',
                         help='Perform a dry run only.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Verify existing files against their manifests.')
+    parser.add_argument('--api-url', type=str, default=config.api_url,
+                        help='URL of the mediawiki API to fetch from.')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of concurrent requests per worker.')
+    parser.add_argument('--rate', type=float, default=10.,
+                        help='Maximum requests per second per worker.')
+    parser.add_argument('--max-retries', type=int, default=5,
+                        help='Number of times to retry a failed request.')
+    parser.add_argument('--store', type=str,
+                        default=os.path.join(config.corpus_directory, 'store'),
+                        help='Directory of the article store shared by all words.')
+    parser.add_argument('--no-store', action='store_true',
+                        help='Save each word\'s articles to its own file instead.')
+    parser.add_argument('--report', type=str,
+                        default=metrics.get_report_name('fetch'),
+                        help='Append timings of this run to this report.')
     args = parser.parse_args()
     dry_run = args.dry_run
+    store_root = None if args.no_store else args.store
+    fetcher_options.update(
+        api_url=args.api_url, num_threads=args.threads, rate=args.rate,
+        max_retries=args.max_retries)
 
     # Read the word list into memory and format using wikimedia conventions.
     # https://en.wikipedia.org/wiki/Wikipedia:Naming_conventions_(capitalization)
@@ -101,9 +316,19 @@ def main():
         words = [w.strip().capitalize() for w in f]
     print('Read {0} words from {1}.'.format(len(words), config.word_list))
 
+    metrics.open_report(args.report, 'fetch_corpus_text',
+                        dict(fetch=len(words)), nproc=args.nproc,
+                        threads=args.threads, rate=args.rate,
+                        store=store_root, dry_run=dry_run)
     pool = multiprocessing.Pool(processes=args.nproc)
-    result = pool.map_async(fetch, words)
+    if args.verify:
+        result = pool.map_async(partial(fetch, verify=True), words)
+    else:
+        result = pool.map_async(fetch, words)
     result.wait()
+    metrics.close_report()
+
+    articles.report(words)
 
 
 if __name__ == '__main__':
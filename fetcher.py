@@ -0,0 +1,218 @@
+from __future__ import print_function, division
+
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+import requests.adapters
+
+import metrics
+
+# Maximum number of titles per query allowed by the mediawiki API for
+# ordinary (non-bot) clients.
+max_titles_per_query = 50
+
+# HTTP status codes that indicate a transient problem worth retrying.
+retry_status = (429, 500, 502, 503, 504)
+
+# Mediawiki API error codes that indicate a transient problem worth retrying.
+retry_codes = ('maxlag', 'ratelimited', 'readonly', 'internal_api_error')
+
+# Errors for pages that exist but have no article text, which fetching again
+# will not change.
+no_content = ('missing', 'disambiguation', 'empty')
+
+
+class FetchError(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """Limit the rate of calls to wait() across all threads of a process.
+    """
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate > 0 else 0.
+        self.lock = threading.Lock()
+        self.next_time = 0.
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ArticleFetcher(object):
+    """Fetch the plain-text content of wiki articles.
+
+    Requests are made from a bounded pool of threads sharing a pool of
+    HTTP connections, subject to an overall rate limit, and failed requests
+    are retried with exponential backoff. Titles are checked for existence
+    and disambiguation in batches of up to 50 per request. Full-text
+    extracts are limited by the TextExtracts API to one per request, but
+    extract_batch can be raised for servers that allow more.
+    """
+    def __init__(self, api_url, num_threads=4, rate=10., max_retries=5,
+                 backoff=1., extract_batch=1, timeout=60.):
+        self.api_url = api_url
+        self.num_threads = num_threads
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.extract_batch = extract_batch
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=num_threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = (
+            'CodeNamesCorpus/1.0 (https://github.com/dkirkby/CodeNames)')
+        self.pool = ThreadPool(processes=num_threads)
+        self.num_requests = 0
+        self.num_retries = 0
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+    def request(self, **params):
+        """Perform one API query and return its decoded JSON result.
+
+        Retries transient failures with exponential backoff and raises
+        FetchError once max_retries is exceeded.
+        """
+        params.update(action='query', format='json', formatversion=2)
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            self.num_requests += 1
+            metrics.count('requests')
+            delay = None
+            try:
+                response = self.session.get(
+                    self.api_url, params=params, timeout=self.timeout)
+                if response.status_code in retry_status:
+                    error = 'HTTP status {0}'.format(response.status_code)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = float(retry_after)
+                else:
+                    response.raise_for_status()
+                    result = response.json()
+                    code = result.get('error', {}).get('code')
+                    if code is None:
+                        return result
+                    if code not in retry_codes:
+                        raise FetchError('API error: {0}'.format(code))
+                    error = 'API error {0}'.format(code)
+            except (requests.RequestException, ValueError) as e:
+                error = str(e)
+            attempt += 1
+            if attempt > self.max_retries:
+                raise FetchError('Giving up after {0} retries: {1}'
+                                 .format(self.max_retries, error))
+            self.num_retries += 1
+            if delay is None:
+                delay = self.backoff * 2 ** (attempt - 1)
+            time.sleep(delay * (1 + 0.25 * random.random()))
+
+    def resolve(self, titles):
+        """Look up a batch of titles.
+
+        Returns a dictionary that maps each title to a tuple of its
+        canonical title (after normalization and redirects) and a status
+        that is None, 'missing' or 'disambiguation'.
+        """
+        result = self.request(
+            titles='|'.join(titles), prop='pageprops',
+            ppprop='disambiguation', redirects=1)
+        query = result.get('query', {})
+        # Map requested titles to their canonical titles.
+        canonical = {}
+        for mapping in query.get('normalized', []) + query.get('redirects', []):
+            canonical[mapping['from']] = mapping['to']
+        status = {}
+        for page in query.get('pages', []):
+            if page.get('missing') or page.get('invalid'):
+                status[page['title']] = 'missing'
+            elif 'disambiguation' in page.get('pageprops', {}):
+                status[page['title']] = 'disambiguation'
+            else:
+                status[page['title']] = None
+        resolved = {}
+        for title in titles:
+            target = title
+            # Follow normalization then redirect (at most two steps).
+            for _ in range(2):
+                target = canonical.get(target, target)
+            resolved[title] = (target, status.get(target, 'missing'))
+        return resolved
+
+    def get_extracts(self, titles):
+        """Fetch the plain-text extracts for a batch of canonical titles.
+
+        Returns a dictionary of title -> content.
+        """
+        result = self.request(
+            titles='|'.join(titles), prop='extracts', explaintext=1,
+            exlimit=len(titles))
+        extracts = {}
+        for page in result.get('query', {}).get('pages', []):
+            if 'extract' in page:
+                extracts[page['title']] = page['extract']
+        return extracts
+
+    def _get_extracts(self, titles):
+        # Wrapper for the thread pool that returns errors instead of raising.
+        try:
+            return self.get_extracts(titles), None
+        except FetchError as e:
+            return {}, str(e)
+
+    def fetch(self, titles):
+        """Generate (title, content, error) tuples in the order of titles.
+
+        The content is None when error is 'missing', 'disambiguation',
+        'empty' (for a page without any extract) or a description of a
+        request that could not be completed. Titles are
+        fetched in small windows so that a consumer that stops early wastes
+        at most one window of requests.
+        """
+        window = self.num_threads * self.extract_batch
+        for first in range(0, len(titles), max_titles_per_query):
+            batch = titles[first:first + max_titles_per_query]
+            try:
+                resolved = self.resolve(batch)
+            except FetchError as e:
+                for title in batch:
+                    yield title, None, str(e)
+                continue
+            for start in range(0, len(batch), window):
+                chunk = batch[start:start + window]
+                wanted = []
+                for title in chunk:
+                    target, status = resolved[title]
+                    if status is None and target not in wanted:
+                        wanted.append(target)
+                groups = [wanted[i:i + self.extract_batch]
+                          for i in range(0, len(wanted), self.extract_batch)]
+                extracts, errors = {}, {}
+                for group, (found, error) in zip(
+                        groups, self.pool.map(self._get_extracts, groups)):
+                    extracts.update(found)
+                    for target in group:
+                        errors[target] = error
+                for title in chunk:
+                    target, status = resolved[title]
+                    if status is not None:
+                        yield title, None, status
+                    elif target in extracts:
+                        yield title, extracts[target], None
+                    else:
+                        yield title, None, errors.get(target) or 'empty'
@@ -5,12 +5,334 @@ import argparse
 import warnings
 import logging
 import random
-import gzip
+import glob
+import json
+import mmap
+import multiprocessing
+import os
 import os.path
+import time
 
+import numpy as np
+
+import codec
+import export
+import mapped_corpus
+import metrics
+import util
 from config import config
 
 
+def get_corpus_name(npass):
+    """Return the name of the shuffled training corpus for a pass.
+    """
+    return config.template['corpus'].format(npass)
+
+
+def read_wordlist(logger):
+    """Read the wordlist into memory.
+    """
+    with open(config.word_list, 'r') as f:
+        wordlist = [w.strip().capitalize() for w in f]
+    logger.info('Read {0} words from {1}.'
+                .format(len(wordlist), config.word_list))
+    return wordlist
+
+
+def get_pairs(npass, wordlist):
+    """Return the random pairs of words used to shuffle a pass.
+
+    The last "pair" might be a single.  This seeds the random generator
+    for the pass, and the sentence order within each pair must then be
+    shuffled in turn to reproduce the same corpus.
+    """
+    # Perform a reproducible random shuffle of the wordlist.
+    wordlist = list(wordlist)
+    random.seed(npass)
+    random.shuffle(wordlist)
+    # Split the wordlist into random pairs.
+    return [wordlist[i:i + 2] for i in range(0, len(wordlist), 2)]
+
+
+def get_preprocessed_name(word):
+    return os.path.join(config.corpus_directory,
+                        config.template['preprocess'].format(word))
+
+
+def build_corpus(npass, corpus_name, logger):
+    """Write a reproducible random shuffle of the preprocessed corpus.
+    """
+    wordlist = read_wordlist(logger)
+
+    # Open the output corpus file for this pass.
+    f_out = codec.open_file(corpus_name, 'wb')
+
+    logger.info('Shuffling the corpus for pass {0} into {1}...'
+                .format(npass, corpus_name))
+    pairs = get_pairs(npass, wordlist)
+    metrics.set_totals(corpus=len(pairs))
+    for pair in pairs:
+        with metrics.measure('corpus', '+'.join(pair)) as measured:
+            sentences = []
+            # Read content for this pair of words into memory.
+            for word in pair:
+                name = get_preprocessed_name(word)
+                with codec.open_file(name, 'rb') as f_in:
+                    for line in f_in:
+                        sentences.append(line)
+
+            # Shuffle sentences for this pair of words into a random order.
+            sentence_order = list(range(len(sentences)))
+            random.shuffle(sentence_order)
+
+            # Save shuffled sentences to the output corpus file.
+            for j in sentence_order:
+                f_out.write(sentences[j])
+            measured.update(sentences=len(sentences))
+
+        logger.info('Added {0} sentences for {1}.'.format(
+            len(sentences), pair))
+
+    f_out.close()
+
+
+def read_sentences(wordlist, data_name):
+    """Read the preprocessed sentences for all words into a single file.
+
+    Returns an array of the byte offset of each line in the file and a
+    dictionary of the (first, last) line numbers for each word.
+    """
+    offsets, ranges = [0], {}
+    with open(data_name, 'wb') as f_out:
+        for word in wordlist:
+            first = len(offsets) - 1
+            with metrics.measure('read', word) as measured:
+                name = get_preprocessed_name(word)
+                with codec.open_file(name, 'rb') as f_in:
+                    for line in f_in:
+                        f_out.write(line)
+                        offsets.append(offsets[-1] + len(line))
+                measured.update(sentences=len(offsets) - 1 - first)
+            ranges[word] = (first, len(offsets) - 1)
+    return np.array(offsets, dtype=np.uint64), ranges
+
+
+def write_shuffled(args):
+    """Write the shuffled corpus for one pass from the combined sentences.
+    """
+    npass, corpus_name, wordlist, data_name, offsets_name, ranges = args
+    offsets = np.load(offsets_name, mmap_mode='r')
+    num_sentences = 0
+    start = time.time()
+    with metrics.measure('shuffle', corpus_name) as measured:
+        with open(data_name, 'rb') as f_in:
+            data = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+            # Write to a temporary file so that a partial corpus is never
+            # used.
+            with codec.open_file(corpus_name + '.tmp', 'wb',
+                                 like=corpus_name) as f_out:
+                for pair in get_pairs(npass, wordlist):
+                    lines = np.concatenate(
+                        [np.arange(*ranges[word]) for word in pair])
+                    sentence_order = list(range(len(lines)))
+                    random.shuffle(sentence_order)
+                    for j in sentence_order:
+                        line = int(lines[j])
+                        f_out.write(data[int(offsets[line]):
+                                         int(offsets[line + 1])])
+                    num_sentences += len(lines)
+            data.close()
+        util.replace_file(corpus_name + '.tmp', corpus_name)
+        measured.update(sentences=num_sentences)
+    return npass, corpus_name, num_sentences, time.time() - start
+
+
+def build_corpora(passes, logger, nproc=None):
+    """Write the shuffled corpora for several passes with a single scan.
+
+    The preprocessed corpus is read and decompressed once into a temporary
+    file, then each pass is shuffled and compressed in its own process.
+    """
+    wordlist = read_wordlist(logger)
+    metrics.set_totals(read=len(wordlist), shuffle=len(passes))
+    data_name = os.path.join(config.corpus_directory, 'sentences.tmp')
+    offsets_name = os.path.join(config.corpus_directory, 'sentences.tmp.npy')
+    try:
+        start = time.time()
+        offsets, ranges = read_sentences(wordlist, data_name)
+        np.save(offsets_name, offsets)
+        logger.info('Read {0} sentences, {1} bytes in {2:.1f}s.'.format(
+            len(offsets) - 1, int(offsets[-1]), time.time() - start))
+
+        tasks = [(npass, get_corpus_name(npass), wordlist, data_name,
+                  offsets_name, ranges) for npass in passes]
+        pool = multiprocessing.Pool(processes=nproc or len(tasks))
+        for npass, corpus_name, num_sentences, elapsed in (
+                pool.imap_unordered(write_shuffled, tasks)):
+            logger.info('Wrote {0} sentences for pass {1} to {2} in {3:.1f}s.'
+                        .format(num_sentences, npass, corpus_name, elapsed))
+        pool.close()
+        pool.join()
+    finally:
+        for name in (data_name, offsets_name):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def get_alpha_range(npass):
+    """Return the (start, stop) learning rates for a pass.
+
+    The learning rate decreases linearly from 0.0251 to 0.0001 over
+    five passes.
+    """
+    return (0.025 - 0.005 * (npass - 1.) + 0.0001,
+            0.025 - 0.005 * npass + 0.0001)
+
+
+def get_mapped_sentences(npass, logger):
+    """Build and convert the corpus for a pass if necessary.
+    """
+    corpus_name = get_corpus_name(npass)
+    if os.path.exists(corpus_name):
+        logger.info('Using corpus {0}'.format(corpus_name))
+    else:
+        build_corpus(npass, corpus_name, logger)
+    mapped_root = mapped_corpus.get_root(corpus_name)
+    if not mapped_corpus.is_converted(corpus_name, mapped_root):
+        logger.info('Converting {0} to mapped tokens...'.format(corpus_name))
+        with metrics.measure('convert', corpus_name):
+            mapped_corpus.convert(corpus_name, mapped_root)
+    return mapped_corpus.MappedSentences(mapped_root)
+
+
+def load_checkpoint(name):
+    """Return the saved training state or None.
+    """
+    try:
+        with open(name + '.json', 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_checkpoint(model, name, state, saved_name=None):
+    """Save a model checkpoint and then the state that refers to it.
+
+    Checkpoints alternate between two slots so that the one referred to
+    by the saved state is never partially overwritten.  When the model has
+    just been saved as saved_name, the state refers to that instead.
+    """
+    if saved_name is None:
+        state['slot'] = 'b' if state.get('slot') == 'a' else 'a'
+        saved_name = '{0}.{1}'.format(name, state['slot'])
+        model.save(saved_name)
+    state['model'] = saved_name
+    tmp_name = name + '.json.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    util.replace_file(tmp_name, name + '.json')
+
+
+def train_all_passes(args, logger, Word2Vec):
+    """Train all passes in a single process with periodic checkpoints.
+
+    Each epoch is divided into segments of the (memory-mapped) corpus.
+    The learning rate decreases linearly from segment to segment, and a
+    checkpoint is saved after each one so that training can be resumed
+    from where it stopped.
+    """
+    num_steps = args.num_epochs * args.segments
+    options = dict(num_passes=args.num_passes, num_epochs=args.num_epochs,
+                   segments=args.segments)
+    state = load_checkpoint(args.checkpoint)
+    if state is not None:
+        if any([state[key] != options[key] for key in options]):
+            print('Checkpoint {0} was saved with different options: {1}'
+                  .format(args.checkpoint, options))
+            return -1
+        # Checkpoints saved before the model name was recorded.
+        model_name = state.get('model', '{0}.{1}'.format(
+            args.checkpoint, state.get('slot')))
+        logger.info('Resuming pass {0} at step {1}/{2} from {3}'.format(
+            state['npass'], state['step'], num_steps, model_name))
+        model = Word2Vec.load(model_name)
+    else:
+        state = dict(options, npass=1, step=0)
+        model = None
+    metrics.set_totals(train=(args.num_passes - state['npass'] + 1) *
+                       num_steps - state['step'])
+
+    # Build any missing corpora for the remaining passes in one scan.
+    missing = [npass for npass in range(state['npass'], args.num_passes + 1)
+               if not os.path.exists(get_corpus_name(npass))]
+    if missing:
+        build_corpora(missing, logger, args.nproc)
+
+    for npass in range(state['npass'], args.num_passes + 1):
+        sentences = get_mapped_sentences(npass, logger)
+        alpha_start, alpha_stop = get_alpha_range(npass)
+        if alpha_stop <= 0:
+            print('Invalid npass gives negative learning rate.')
+            return -1
+        logger.info('Pass {0} learning rate: {1:.4f} -> {2:.4f}'
+                    .format(npass, alpha_start, alpha_stop))
+        if model is None:
+            # Train a new model using the vocabulary of the first pass.
+            model = Word2Vec(
+                size=args.dimension, window=args.max_distance,
+                min_count=args.min_count, workers=args.workers,
+                sg=1, hs=1, iter=1)
+            model.build_vocab(sentences)
+        model.workers = args.workers
+        model.iter = 1
+
+        # Split each epoch into segments of roughly equal numbers of lines.
+        bounds = [sentences.num_lines * i // args.segments
+                  for i in range(args.segments + 1)]
+        for step in range(state['step'], num_steps):
+            epoch, segment = divmod(step, args.segments)
+            part = sentences.view(bounds[segment], bounds[segment + 1])
+            model.alpha = alpha_start + (
+                alpha_stop - alpha_start) * step / num_steps
+            model.min_alpha = alpha_start + (
+                alpha_stop - alpha_start) * (step + 1) / num_steps
+            start, cpu_start = time.time(), os.times()
+            with metrics.measure('train', 'pass {0} step {1}'.format(
+                    npass, step + 1), words=part.num_words()):
+                model.train(part, total_examples=len(part))
+            elapsed, cpu_stop = time.time() - start, os.times()
+            # Average utilization of the worker threads, estimated from the
+            # CPU time used by this process.
+            cpu = (cpu_stop[0] + cpu_stop[1]) - (cpu_start[0] + cpu_start[1])
+            logger.info(
+                'Pass {0} epoch {1}/{2} segment {3}/{4}: {5} words in {6:.1f}s '
+                '({7:.0f} words/s, {8:.0%} utilization of {9} workers)'.format(
+                    npass, epoch + 1, args.num_epochs, segment + 1,
+                    args.segments, part.num_words(), elapsed,
+                    part.num_words() / elapsed if elapsed > 0 else 0.,
+                    cpu / (elapsed * args.workers) if elapsed > 0 else 0.,
+                    args.workers))
+            if step + 1 < num_steps:
+                state['step'] = step + 1
+                save_checkpoint(model, args.checkpoint, state)
+
+        # Save the updated model after this pass.
+        save_name = '{0}.{1}'.format(config.embedding, npass)
+        model.save(save_name)
+        logger.info('Saved {0}'.format(save_name))
+        state['npass'], state['step'] = npass + 1, 0
+        if npass < args.num_passes:
+            save_checkpoint(model, args.checkpoint, state, save_name)
+
+    # Save only what is needed for playing.
+    export.export(model, config.embedding)
+    logger.info('Exported {0}'.format(config.embedding))
+
+    # Remove the checkpoints now that all passes are saved.
+    for name in glob.glob(args.checkpoint + '.*'):
+        os.remove(name)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Merge training corpus.',
@@ -27,10 +349,31 @@ def main():
                         help='Max distance between words within a sentence')
     parser.add_argument('--workers', type=int, default=4,
                         help='Number of workers to distribute workload across.')
+    parser.add_argument('--mapped', action='store_true',
+                        help='Train from a memory-mapped tokenized corpus.')
+    parser.add_argument('--all-passes', action='store_true',
+                        help='Run all passes in this process with checkpoints.')
+    parser.add_argument('--num-passes', type=int, default=5,
+                        help='Number of passes to run with --all-passes.')
+    parser.add_argument('--segments', type=int, default=5,
+                        help='Number of checkpoints per epoch with --all-passes.')
+    parser.add_argument('--checkpoint', type=str, default='word2vec.ckpt',
+                        help='Name used for --all-passes checkpoints.')
+    parser.add_argument('--prepare-passes', type=int, default=0,
+                        help='Only build the corpora for this many passes.')
+    parser.add_argument('--nproc', type=int, default=None,
+                        help='Number of corpora to build concurrently '
+                        '(default is one per pass).')
+    parser.add_argument('--export', action='store_true',
+                        help='Export the trained model for playing as {0}.'
+                        .format(config.embedding))
     parser.add_argument('--log-level', type=str, default='INFO',
                         choices=('CRITICAL', 'ERROR', 'WARNING',
                                  'INFO', 'DEBUG'),
                         help='Filter out log messages below this level.')
+    parser.add_argument('--report', type=str,
+                        default=metrics.get_report_name('learn'),
+                        help='Append timings of this run to this report.')
     args = parser.parse_args()
 
     # Configure logging.
@@ -38,59 +381,30 @@ def main():
         format='%(asctime)s : %(levelname)s : %(message)s',
         level=getattr(logging, args.log_level))
     logger = logging.getLogger('learn')
+    metrics.open_report(args.report, 'learn', {}, **vars(args))
+
+    if args.prepare_passes > 0:
+        build_corpora(range(1, args.prepare_passes + 1), logger, args.nproc)
+        metrics.close_report()
+        return
+
+    if args.all_passes:
+        # Import gensim here so we can mute a UserWarning about the Pattern
+        # library not being installed.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            import gensim.models.word2vec
+        result = train_all_passes(
+            args, logger, gensim.models.word2vec.Word2Vec)
+        metrics.close_report()
+        return result
 
     # Look for an existing corpus for this pass.
-    corpus_name = 'corpus_{0}.gz'.format(args.npass)
+    corpus_name = get_corpus_name(args.npass)
     if os.path.exists(corpus_name):
         logger.info('Using corpus {0}'.format(corpus_name))
     else:
-        # Read the wordlist into memory.
-        with open(config.word_list, 'r') as f:
-            wordlist = [w.strip().capitalize() for w in f]
-        logger.info('Read {0} words from {1}.'
-                    .format(len(wordlist), config.word_list))
-
-        # Open the output corpus file for this pass.
-        f_out = gzip.open(corpus_name, 'wb')
-
-        # Perform a reproducible random shuffle of the wordlist.
-        logger.info('Shuffling the corpus for pass {0} into {1}...'
-                    .format(args.npass, corpus_name))
-        random.seed(args.npass)
-        random.shuffle(wordlist)
-
-        # Split the wordlist into random pairs.
-        for i in range(0, len(wordlist), 2):
-            sentences = []
-            # Read content for the first word of this pair into memory.
-            in_name = os.path.join(
-                config.corpus_directory,
-                config.template['preprocess'].format(wordlist[i]))
-            with gzip.open(in_name, 'rb') as f_in:
-                for line in f_in:
-                    sentences.append(line)
-            # The last "pair" might be a single.
-            if i < len(wordlist) - 1:
-                in_name = os.path.join(
-                    config.corpus_directory,
-                    config.template['preprocess'].format(wordlist[i+1]))
-                # Read content for the second word of this pair into memory.
-                with gzip.open(in_name, 'rb') as f_in:
-                    for line in f_in:
-                        sentences.append(line)
-
-            # Shuffle sentences for this pair of words into a random order.
-            sentence_order = range(len(sentences))
-            random.shuffle(sentence_order)
-
-            # Save shuffled sentences to the output corpus file.
-            for j in sentence_order:
-                f_out.write(sentences[j])
-
-            logger.info('Added {0} sentences for ({1}, {2}).'.format(
-                len(sentences), wordlist[i], wordlist[i+1]))
-
-        f_out.close()
+        build_corpus(args.npass, corpus_name, logger)
 
     # Import gensim here so we can mute a UserWarning about the Pattern
     # library not being installed.
@@ -99,17 +413,28 @@ def main():
         import gensim.models.word2vec
 
     # Use the training sentences for this pass.
-    sentences = gensim.models.word2vec.LineSentence(corpus_name)
+    if args.mapped:
+        # Convert the corpus once so that each epoch reads pre-tokenized
+        # integers instead of decompressing and splitting text.
+        mapped_root = mapped_corpus.get_root(corpus_name)
+        if not mapped_corpus.is_converted(corpus_name, mapped_root):
+            logger.info('Converting {0} to mapped tokens...'
+                        .format(corpus_name))
+            with metrics.measure('convert', corpus_name):
+                mapped_corpus.convert(corpus_name, mapped_root)
+        sentences = mapped_corpus.MappedSentences(mapped_root)
+    else:
+        sentences = codec.LineSentence(corpus_name)
 
     # Calculate start and stop learning rates for this pass.
-    alpha_start = 0.025 - 0.005 * (args.npass - 1.) + 0.0001
-    alpha_stop = 0.025 - 0.005 * args.npass + 0.0001
+    alpha_start, alpha_stop = get_alpha_range(args.npass)
     if alpha_stop <= 0:
         print('Invalid npass gives negative learning rate.')
         return -1
     logger.info('Learning rate: {0:.4f} -> {1:.4f}'
                 .format(alpha_start, alpha_stop))
 
+    metrics.set_totals(train=1)
     if args.npass > 1:
         # Load a previously trained model.
         prev_name = '{0}.{1}'.format(config.embedding, args.npass - 1)
@@ -120,18 +445,24 @@ def main():
         model.alpha = alpha_start
         model.min_alpha = alpha_stop
         # Continue training.
-        model.train(sentences)
+        with metrics.measure('train', 'pass {0}'.format(args.npass)):
+            model.train(sentences)
     else:
         # Train a new model.
-        model = gensim.models.word2vec.Word2Vec(
-            sentences, size=args.dimension, window=args.max_distance,
-            min_count=args.min_count, workers=args.workers,
-            alpha=alpha_start, min_alpha=alpha_stop,
-            sg=1, hs=1, iter=args.num_epochs)
+        with metrics.measure('train', 'pass {0}'.format(args.npass)):
+            model = gensim.models.word2vec.Word2Vec(
+                sentences, size=args.dimension, window=args.max_distance,
+                min_count=args.min_count, workers=args.workers,
+                alpha=alpha_start, min_alpha=alpha_stop,
+                sg=1, hs=1, iter=args.num_epochs)
 
     # Save the updated model after this pass.
     save_name = '{0}.{1}'.format(config.embedding, args.npass)
     model.save(save_name)
+    if args.export:
+        export.export(model, config.embedding)
+        logger.info('Exported {0}'.format(config.embedding))
+    metrics.close_report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import copy
+import io
+import json
+import os
+import os.path
+import time
+
+import numpy as np
+
+import codec
+import util
+from config import config
+
+
+def get_names(root):
+    """Return the (vocab, tokens, offsets, header) filenames for a mapped
+    corpus.
+    """
+    return (root + '.vocab', root + '.tokens.npy', root + '.offsets.npy',
+            root + '.mapped.json')
+
+
+def get_root(corpus_name):
+    """Return the filename root used for the mapped version of a corpus.
+    """
+    return codec.strip_suffix(corpus_name)
+
+
+def get_signature(corpus_name):
+    """Return a string that changes whenever a corpus file is rebuilt.
+    """
+    return '{0}:{1:.6f}'.format(os.path.getsize(corpus_name),
+                                os.path.getmtime(corpus_name))
+
+
+def is_converted(corpus_name, root=None):
+    """Has the current version of a corpus been completely converted?
+
+    The header is only written once all of the other mapped files are
+    complete, and records the signature of the corpus they came from.
+    """
+    if root is None:
+        root = get_root(corpus_name)
+    names = get_names(root)
+    if not all([os.path.exists(name) for name in names]):
+        return False
+    try:
+        with open(names[3], 'r') as f_in:
+            header = json.load(f_in)
+    except (IOError, OSError, ValueError):
+        return False
+    return header.get('source') == get_signature(corpus_name)
+
+
+def _copy_raw(raw_name, npy_name, dtype, chunk_size=1 << 24):
+    # Copy a raw binary file into a .npy file without reading it all into
+    # memory at once.
+    size = os.path.getsize(raw_name) // np.dtype(dtype).itemsize
+    out = np.lib.format.open_memmap(npy_name, mode='w+', dtype=dtype,
+                                    shape=(size,))
+    if size > 0:
+        raw = np.memmap(raw_name, dtype=dtype, mode='r', shape=(size,))
+        for start in range(0, size, chunk_size):
+            out[start:start + chunk_size] = raw[start:start + chunk_size]
+        del raw
+    out.flush()
+    del out
+    os.remove(raw_name)
+
+
+def convert(corpus_name, root=None, chunk_size=1 << 20):
+    """Convert a (compressed) text corpus into a memory-mappable token corpus.
+
+    The output consists of a vocabulary file with one "word count" line per
+    token ID, a uint32 array of token IDs for the whole corpus and a uint64
+    array of sentence offsets into the token array.  Tokens are assigned IDs
+    in the order they are first seen.  Every file is written to a temporary
+    name and only moved into place once all of them are complete, followed
+    by a header recording the signature of the corpus.
+    """
+    if root is None:
+        root = get_root(corpus_name)
+    vocab_name, tokens_name, offsets_name, header_name = get_names(root)
+    if os.path.exists(header_name):
+        os.remove(header_name)
+    source = get_signature(corpus_name)
+    tokens_raw, offsets_raw = tokens_name + '.raw', offsets_name + '.raw'
+
+    vocab, counts = {}, []
+    num_sentences, num_tokens = 0, 0
+    token_buffer, offset_buffer = [], [0]
+    with codec.open_file(corpus_name, 'rb') as f_in, \
+            open(tokens_raw, 'wb') as f_tokens, \
+            open(offsets_raw, 'wb') as f_offsets:
+        for line in f_in:
+            for word in line.decode(config.encoding).split():
+                token = vocab.get(word)
+                if token is None:
+                    token = vocab[word] = len(counts)
+                    counts.append(0)
+                counts[token] += 1
+                token_buffer.append(token)
+            num_sentences += 1
+            offset_buffer.append(num_tokens + len(token_buffer))
+            # Flush the buffers to disk periodically.
+            if len(token_buffer) >= chunk_size:
+                np.array(token_buffer, dtype=np.uint32).tofile(f_tokens)
+                num_tokens += len(token_buffer)
+                token_buffer = []
+                np.array(offset_buffer, dtype=np.uint64).tofile(f_offsets)
+                offset_buffer = []
+        np.array(token_buffer, dtype=np.uint32).tofile(f_tokens)
+        num_tokens += len(token_buffer)
+        np.array(offset_buffer, dtype=np.uint64).tofile(f_offsets)
+
+    # Save the vocabulary in token ID order.
+    words = sorted(vocab, key=vocab.get)
+    with io.open(vocab_name + '.tmp', 'w', encoding=config.encoding) as f_out:
+        for word, count in zip(words, counts):
+            f_out.write(u'{0} {1}\n'.format(word, count))
+
+    _copy_raw(tokens_raw, tokens_name + '.tmp', np.uint32)
+    _copy_raw(offsets_raw, offsets_name + '.tmp', np.uint64)
+    for name in (vocab_name, tokens_name, offsets_name):
+        util.replace_file(name + '.tmp', name)
+
+    header = dict(source=source, num_sentences=num_sentences,
+                  num_tokens=num_tokens, num_words=len(words))
+    with open(header_name + '.tmp', 'w') as f_out:
+        json.dump(header, f_out)
+    util.replace_file(header_name + '.tmp', header_name)
+
+    return num_sentences, num_tokens, len(words)
+
+
+class MappedSentences(object):
+    """Iterate over the sentences of a memory-mapped token corpus.
+
+    Each iteration yields lists of unicode words, the same as gensim's
+    LineSentence, but without any decompression or string splitting.
+    Sentences longer than max_sentence_length are split into chunks,
+    again for consistency with LineSentence.  Use view() to iterate over
+    a subset of the corpus lines.
+    """
+    def __init__(self, root, max_sentence_length=10000, block_size=10000):
+        vocab_name, tokens_name, offsets_name, _ = get_names(root)
+        with io.open(vocab_name, 'r', encoding=config.encoding) as f_in:
+            self.words, self.counts = [], []
+            for line in f_in:
+                word, count = line.rsplit(' ', 1)
+                self.words.append(word)
+                self.counts.append(int(count))
+        self.vocab = np.empty(len(self.words), dtype=object)
+        self.vocab[:] = self.words
+        self.tokens = np.load(tokens_name, mmap_mode='r')
+        self.offsets = np.load(offsets_name, mmap_mode='r')
+        self.max_sentence_length = max_sentence_length
+        self.block_size = block_size
+        self.start, self.stop = 0, len(self.offsets) - 1
+
+    @property
+    def num_lines(self):
+        return self.stop - self.start
+
+    def view(self, start, stop):
+        """Return an iterable over corpus lines [start, stop) only.
+        """
+        result = copy.copy(self)
+        result.start = max(0, start)
+        result.stop = min(stop, len(self.offsets) - 1)
+        return result
+
+    def num_words(self):
+        """Return the number of words in this view.
+        """
+        return int(self.offsets[self.stop]) - int(self.offsets[self.start])
+
+    def __len__(self):
+        # Count the (possibly split) non-empty sentences we will yield.
+        offsets = self.offsets[self.start:self.stop + 1].astype(np.int64)
+        lengths = np.diff(offsets)
+        return int(np.sum((lengths + self.max_sentence_length - 1) //
+                          self.max_sentence_length))
+
+    def __iter__(self):
+        max_length = self.max_sentence_length
+        for first in range(self.start, self.stop, self.block_size):
+            # Look up all words for a block of sentences at once.
+            last = min(first + self.block_size, self.stop)
+            offsets = self.offsets[first:last + 1]
+            start = int(offsets[0])
+            words = self.vocab[self.tokens[start:int(offsets[-1])]].tolist()
+            for i in range(len(offsets) - 1):
+                lo, hi = int(offsets[i]) - start, int(offsets[i + 1]) - start
+                while lo < hi:
+                    yield words[lo:min(hi, lo + max_length)]
+                    lo += max_length
+
+
+def measure(sentences):
+    """Time a single epoch of iterating over sentences.
+
+    Returns the elapsed time in seconds and the number of sentences and
+    words seen.
+    """
+    num_sentences, num_words = 0, 0
+    start = time.time()
+    for sentence in sentences:
+        num_sentences += 1
+        num_words += len(sentence)
+    return time.time() - start, num_sentences, num_words
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a training corpus to memory-mapped tokens.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('corpus', type=str,
+                        help='Name of the training corpus to convert.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Time one epoch of reading each corpus format.')
+    args = parser.parse_args()
+
+    root = get_root(args.corpus)
+    if is_converted(args.corpus, root):
+        print('Using existing mapped corpus {0}.*'.format(root))
+    else:
+        start = time.time()
+        num_sentences, num_tokens, num_words = convert(args.corpus, root)
+        print('Converted {0} sentences, {1} tokens, {2} words in {3:.1f}s.'
+              .format(num_sentences, num_tokens, num_words,
+                      time.time() - start))
+
+    if args.benchmark:
+        for label, sentences in (
+                ('text', codec.LineSentence(args.corpus)),
+                ('mapped', MappedSentences(root))):
+            elapsed, num_sentences, num_words = measure(sentences)
+            print('{0:>6s}: {1:.1f}s per epoch for {2} sentences, {3} words '
+                  '({4:.0f} words/s)'.format(label, elapsed, num_sentences,
+                                             num_words, num_words / elapsed))
+
+
+if __name__ == '__main__':
+    main()
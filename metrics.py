@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Throughput metrics and run reports for the corpus scripts.
+
+Each process keeps counters of the bytes read and written through codec,
+and of the requests made to a wiki.  A script opens a report before
+starting any worker processes, then times each word (or other item) of
+each stage with measure(), which appends one JSON line with the elapsed
+time and the change in every counter to the report.  Worker processes
+append to the same report directly.  Running this module summarizes the
+throughput of each stage and the estimated time remaining.
+"""
+from __future__ import print_function, division
+
+import argparse
+import collections
+import json
+import os
+import os.path
+import threading
+import time
+
+from config import config
+
+_counters = collections.defaultdict(int)
+_lock = threading.Lock()
+
+# The name and id of the open report, shared with worker processes.
+_report = None
+
+
+def get_report_name(script):
+    """Return the default report filename for a script.
+    """
+    return os.path.join(config.corpus_directory,
+                        config.template['report'].format(script))
+
+
+def count(name, n=1):
+    """Add n to a counter of this process.
+    """
+    with _lock:
+        _counters[name] += n
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def write(event, report=None, **fields):
+    """Append one record to a report, by default the open report if any.
+    """
+    report = report or _report
+    if report is None:
+        return
+    fields.update(run=report['run'], event=event, time=time.time())
+    line = (json.dumps(fields, sort_keys=True) + '\n').encode('utf8')
+    # Each record is a single append so that lines from different
+    # processes are never interleaved.
+    fd = os.open(report['name'], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def open_report(name, script, totals, **options):
+    """Start a new run in the report name (appending to any earlier runs).
+
+    The totals dictionary gives the number of items expected for each
+    stage, which is used to estimate the time remaining.  Returns the new
+    report, which becomes the open report of this process and of any
+    worker processes started before another report is opened.
+    """
+    global _report
+    directory = os.path.dirname(name)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    _report = dict(name=name, run='{0}-{1}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    write('start', script=script, totals=totals, options=options)
+    return _report
+
+
+def set_totals(**totals):
+    """Set the number of items expected for some stages of the open report.
+    """
+    write('totals', totals=totals)
+
+
+def close_report(report=None, **fields):
+    """Finish a run of a report, by default the open report.
+    """
+    global _report
+    report = report or _report
+    write('end', report, **fields)
+    if report is _report:
+        _report = None
+
+
+def skip(stage, item, report=None):
+    """Report an item whose output was already done without measuring it.
+    """
+    write('item', report, stage=stage, item=item, start=time.time(),
+          elapsed=0., cpu=0., pid=os.getpid(), counters={}, skipped=True)
+
+
+class measure(object):
+    """Time one item of a stage and report it with its counters.
+
+    The elapsed time is reported with the CPU time used by this process,
+    so that a stage that waits on input or requests can be recognized.
+
+    Additional fields, e.g. the number of sentences of a word, can be added
+    to the record with update().  Items that found their output already
+    done should be marked with update(skipped=True).
+    """
+    def __init__(self, stage, item, **fields):
+        self.stage = stage
+        self.item = item
+        self.fields = fields
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start, self.times = time.time(), os.times()
+        self.counters = get_counters()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop, times = time.time(), os.times()
+        self.elapsed = self.stop - self.start
+        # CPU time used by all threads of this process.
+        cpu = (times[0] + times[1]) - (self.times[0] + self.times[1])
+        counters = dict((name, n - self.counters.get(name, 0))
+                        for name, n in get_counters().items())
+        if exc_type is not None:
+            self.fields['error'] = '{0}: {1}'.format(
+                exc_type.__name__, exc_value)
+        write('item', stage=self.stage, item=self.item, start=self.start,
+              elapsed=self.elapsed, cpu=cpu, pid=os.getpid(),
+              counters=dict((name, n) for name, n in counters.items() if n),
+              **self.fields)
+
+
+def load_runs(names):
+    """Read reports and return a list of runs in the order they started.
+
+    Each run is a dictionary with the records of its 'start', 'items' and
+    'end' (None for a run that is still going or was interrupted), and the
+    'totals' for each stage.
+    """
+    runs = collections.OrderedDict()
+    for name in names:
+        with open(name, 'r') as f_in:
+            for line in f_in:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Ignore a partial line from an interrupted run.
+                    continue
+                run = runs.setdefault(record['run'], dict(
+                    start=None, items=[], end=None, totals={}))
+                if record['event'] == 'item':
+                    run['items'].append(record)
+                elif record['event'] == 'totals':
+                    run['totals'].update(record['totals'])
+                else:
+                    run[record['event']] = record
+                    run['totals'].update(record.get('totals', {}))
+    return sorted([run for run in runs.values() if run['start'] is not None],
+                  key=lambda run: run['start']['time'])
+
+
+def format_time(seconds):
+    if seconds < 120:
+        return '{0:.0f}s'.format(seconds)
+    if seconds < 7200:
+        return '{0:.1f}m'.format(seconds / 60)
+    return '{0:.1f}h'.format(seconds / 3600)
+
+
+def summarize(run, num_slowest=5):
+    """Print the throughput of each stage of a run and its time remaining.
+
+    The estimate assumes that the remaining items of a stage take as long
+    on average, with the same concurrency, as those already run (ignoring
+    items that were skipped because they were already done).
+    """
+    start = run['start']
+    stop = run['end']['time'] if run['end'] else max(
+        [start['time']] + [item['start'] + item['elapsed']
+                           for item in run['items']])
+    print('Run {0} of {1}: {2} {3}.'.format(
+        start['run'], start['script'],
+        'finished after' if run['end'] else 'running or interrupted after',
+        format_time(stop - start['time'])))
+    stages = []
+    for item in run['items']:
+        if item['stage'] not in stages:
+            stages.append(item['stage'])
+    stages += sorted([stage for stage in run['totals']
+                      if stage not in stages])
+    print('     STAGE   DONE  TOTAL  SKIP  FAIL   BUSY(s)    CPU(s)   WALL(s)'
+          '  ITEMS/MIN'
+          '  READ(MB)  WRITE(MB)   MB/s  REQUESTS  REQ/s      ETA')
+    for stage in stages:
+        items = [item for item in run['items'] if item['stage'] == stage]
+        total = run['totals'].get(stage)
+        num_skipped = sum([1 for item in items if item.get('skipped')])
+        num_failed = sum([1 for item in items if item.get('error')])
+        num_run = len(items) - num_skipped
+        busy = sum([item['elapsed'] for item in items])
+        cpu = sum([item.get('cpu', 0.) for item in items])
+        wall = (max([item['start'] + item['elapsed'] for item in items]) -
+                min([item['start'] for item in items])) if items else 0.
+        counters = collections.defaultdict(int)
+        for item in items:
+            for name, n in item['counters'].items():
+                counters[name] += n
+        mb_read = counters['bytes_read'] / 1e6
+        mb_written = counters['bytes_written'] / 1e6
+        line = ('{0:>10s} {1:6d} {2:>6s} {3:5d} {4:5d} {5:9.1f} {6:9.1f} '
+                '{7:9.1f}'.format(stage, len(items),
+                                  '-' if total is None else str(total),
+                                  num_skipped, num_failed, busy, cpu, wall))
+        rate = 1. / wall if wall > 0 else 0.
+        line += ' {0:10.2f} {1:9.1f} {2:10.1f} {3:6.1f} {4:9d} {5:6.2f}'.format(
+            60 * num_run * rate, mb_read, mb_written,
+            (mb_read + mb_written) * rate, counters['requests'],
+            counters['requests'] * rate)
+        if total is None:
+            eta = ''
+        elif len(items) >= total:
+            eta = 'done'
+        elif num_run > 0:
+            eta = format_time((total - len(items)) * wall / num_run)
+        else:
+            eta = '?'
+        print(line + ' {0:>8s}'.format(eta))
+
+    slowest = sorted([item for item in run['items'] if not item.get('skipped')],
+                     key=lambda item: item['elapsed'], reverse=True)
+    if slowest[:num_slowest]:
+        print('Slowest items:')
+    for item in slowest[:num_slowest]:
+        print('{0:>10s} {1:9.1f}s  {2}{3}'.format(
+            item['stage'], item['elapsed'], item['item'],
+            '  (failed)' if item.get('error') else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize the throughput of the corpus scripts.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('reports', type=str, nargs='*', default=[
+        get_report_name(script) for script in
+        ('index', 'fetch', 'preprocess', 'learn')],
+        help='Run reports to summarize.')
+    parser.add_argument('--all', action='store_true',
+                        help='Summarize every run instead of the latest run '
+                        'in each report.')
+    parser.add_argument('--slowest', type=int, default=5,
+                        help='Number of slowest items to list for each run.')
+    args = parser.parse_args()
+
+    for name in args.reports:
+        if not os.path.exists(name):
+            continue
+        runs = load_runs([name])
+        for run in (runs if args.all else runs[-1:]):
+            summarize(run, args.slowest)
+            print()
+
+
+if __name__ == '__main__':
+    main()
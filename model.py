@@ -8,29 +8,55 @@ import nltk.stem.wordnet
 
 import sklearn.cluster
 
+import clue_table
+import export
+
 
 class WordEmbedding(object):
 
     def __init__(self, filename):
-        # Import gensim here so we can mute a UserWarning about the Pattern
-        # library not being installed.
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', UserWarning)
-            import gensim.models.word2vec
+        if export.is_exported(filename):
+            # Load only the normalized vectors and vocabulary.
+            self.model = export.CompactModel(filename)
+        else:
+            # Import gensim here so we can mute a UserWarning about the
+            # Pattern library not being installed.
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                import gensim.models.word2vec
 
-        # Load the model.
-        self.model = gensim.models.word2vec.Word2Vec.load(filename)
+            # Load the model.
+            self.model = gensim.models.word2vec.Word2Vec.load(filename)
 
-        # Reduce the memory footprint since we will not be training.
-        self.model.init_sims(replace=True)
+            # Reduce the memory footprint since we will not be training.
+            self.model.init_sims(replace=True)
 
         # Initialize a wordnet lemmatizer for stemming.
         self.lemmatizer = nltk.stem.wordnet.WordNetLemmatizer()
+        self.stems = {}
+
+        # Use precomputed clues for groups of words if they are up to date.
+        self.clue_table = None
+        if clue_table.exists(filename):
+            table = clue_table.ClueTable(filename)
+            if table.is_current():
+                self.clue_table = table
+            else:
+                print('Ignoring clue tables for an older version of {0}.'
+                      .format(filename))
 
 
     def get_stem(self, word):
         """Return the stem of word.
         """
+        # Stems are memoized since the same words are checked repeatedly.
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.stems[word] = self._get_stem(word)
+        return stem
+
+
+    def _get_stem(self, word):
         # Hardcode some stemming rules for the default CodeName words
         # that the wordnet lemmatizer doesn't know about.
         if word in ('pass', 'passing', 'passed',):
@@ -47,90 +73,172 @@ class WordEmbedding(object):
         return self.lemmatizer.lemmatize(word).encode('ascii', 'ignore')
 
 
+    def get_indices(self, words):
+        """Return the vocabulary indices of words.
+
+        The words can also be given as an array of vocabulary indices, which
+        is returned unchanged.
+        """
+        words = np.asarray(words)
+        if words.dtype.kind in 'iu':
+            return words
+        return np.array([self.model.vocab[word].index for word in words],
+                        dtype=np.int64)
+
+
+    def get_words(self, indices):
+        """Return a list of the words with some vocabulary indices.
+
+        The indices can also be given as words, which are returned unchanged.
+        """
+        indices = np.asarray(indices)
+        if indices.dtype.kind not in 'iu':
+            return list(indices)
+        return [self.model.index2word[index] for index in indices.tolist()]
+
+
+    def get_mean_vector(self, words):
+        """Return the normalized mean vector of some words or indices.
+        """
+        indices = np.sort(self.get_indices(words))
+        mean_vector = self.model.syn0norm[indices].mean(axis=0)
+        return mean_vector / np.sqrt(mean_vector.dot(mean_vector))
+
+
+    def get_closest(self, mean_vectors, num_search=100):
+        """Find the vocabulary words closest to each of several vectors.
+
+        Returns an array with one row per vector of the indices of the
+        num_search words with the largest cosine similarity, in decreasing
+        order of similarity.
+        """
+        mean_vectors = np.asarray(mean_vectors,
+                                  dtype=self.model.syn0norm.dtype)
+        # Calculate the cosine similarities between each mean vector and all
+        # the words in our vocabulary with a single matrix product.
+        cosines = np.dot(mean_vectors, self.model.syn0norm.T)
+        num_words = cosines.shape[1]
+        num_search = min(num_search, num_words)
+        # Only sort the largest cosines for each vector.
+        rows = np.arange(len(mean_vectors))[:, np.newaxis]
+        if num_search < num_words:
+            top = np.argpartition(-cosines, num_search - 1, axis=1)
+            top = top[:, :num_search]
+        else:
+            top = np.tile(np.arange(num_words), (len(mean_vectors), 1))
+        order = np.argsort(-cosines[rows, top], axis=1, kind='mergesort')
+        return top[rows, order]
+
+
+    def get_group_closest(self, groups, num_search=100, batch_size=64):
+        """Find the vocabulary words closest to each group of words.
+
+        Returns the indices of the num_search closest words to the mean
+        vector of each group, from the clue tables when possible.  The
+        remaining groups are searched batch_size at a time.
+        """
+        closest, missing = [None] * len(groups), []
+        for i, words in enumerate(groups):
+            if self.clue_table is not None:
+                closest[i] = self.clue_table.lookup(
+                    self.get_words(words), num_search)
+            if closest[i] is None:
+                missing.append(i)
+        for first in range(0, len(missing), batch_size):
+            batch = missing[first:first + batch_size]
+            rows = self.get_closest(
+                [self.get_mean_vector(groups[i]) for i in batch], num_search)
+            for i, row in zip(batch, rows):
+                closest[i] = row
+        return closest
+
+
     def get_clue(self, clue_words, pos_words, neg_words, veto_words,
                  veto_margin=0.2, num_search=100, verbose=0):
         """
         """
-        if verbose >= 2:
-            print('CLUE:', clue_words)
-            print(' POS:', pos_words)
-            print(' NEG:', neg_words)
-            print('VETO:', veto_words)
+        closest = self.get_group_closest([clue_words], num_search)[0]
+        return self.select_clue(clue_words, pos_words, neg_words, veto_words,
+                                closest, veto_margin, verbose)
 
-        # Initialize the list of illegal clues.
-        illegal_words = list(pos_words) + list(neg_words) + list(veto_words)
-        illegal_stems = set([self.get_stem(word) for word in illegal_words])
 
+    def select_clue(self, clue_words, pos_words, neg_words, veto_words,
+                    closest, veto_margin=0.2, verbose=0, legal=None):
+        """Select the best clue for a group from candidate word indices.
+
+        The candidates are normally the result of get_closest() for the
+        mean vector of the clue words.  The clue, pos, neg and veto words
+        can be given as words or vocabulary indices.  Calls with the same
+        pos, neg and veto words can share a legal dictionary to remember
+        which candidates are legal clues.
+        """
         # Get the internal indices and normalized vectors for each word.
-        clue_indices = [self.model.vocab[word].index for word in clue_words]
+        clue_indices = self.get_indices(clue_words)
         clue_vectors = self.model.syn0norm[clue_indices]
-        pos_indices = [self.model.vocab[word].index for word in pos_words]
-        pos_vectors = self.model.syn0norm[pos_indices]
-        neg_indices = [self.model.vocab[word].index for word in neg_words]
+        neg_indices = self.get_indices(neg_words)
         neg_vectors = self.model.syn0norm[neg_indices]
-        veto_indices = [self.model.vocab[word].index for word in veto_words]
+        veto_indices = self.get_indices(veto_words)
         veto_vectors = self.model.syn0norm[veto_indices]
 
-        # Find the normalized mean of the words in the clue group.
-        mean_vector = clue_vectors.mean(axis=0)
-        mean_vector /= np.sqrt(mean_vector.dot(mean_vector))
+        # Initialize the list of illegal clues.
+        pos_words = self.get_words(pos_words)
+        neg_words = self.get_words(neg_indices)
+        veto_words = self.get_words(veto_indices)
+        illegal_words = pos_words + neg_words + veto_words
+        if legal is None:
+            legal = {}
 
-        # Calculate the cosine distances between the mean vector and all
-        # the words in our vocabulary.
-        cosines = np.dot(self.model.syn0norm[:, np.newaxis],
-                         mean_vector).reshape(-1)
+        if verbose >= 2:
+            print('CLUE:', self.get_words(clue_indices))
+            print(' POS:', pos_words)
+            print(' NEG:', neg_words)
+            print('VETO:', veto_words)
 
-        # Sort the vocabulary by decreasing cosine similarity with the mean.
-        closest = np.argsort(cosines)[::-1]
+        # Calculate the cosine similarity of every candidate with all of the
+        # clue, negative and veto words at once.
+        candidate_vectors = self.model.syn0norm[closest]
+        clue_cosines = np.dot(candidate_vectors, clue_vectors.T)
+        min_clue_cosines = clue_cosines.min(axis=1).tolist()
+        if neg_words:
+            neg_cosines = np.dot(candidate_vectors, neg_vectors.T)
+            max_neg_cosines = neg_cosines.max(axis=1).tolist()
+        if veto_words:
+            veto_cosines = np.dot(candidate_vectors, veto_vectors.T)
+            max_veto_cosines = veto_cosines.max(axis=1).tolist()
 
         # Select the clue whose minimum cosine from the words is largest
         # (i.e., smallest maximum distance).
         best_clue = None
         max_min_cosine = -2.
-        for i in range(num_search):
-            clue_index = closest[i]
+        for i, clue_index in enumerate(closest.tolist()):
             clue = self.model.index2word[clue_index]
-            # Ignore clues with the same stem as an illegal clue.
-            if self.get_stem(clue) in illegal_stems:
-                continue
-            # Ignore clues that are contained within an illegal clue or
-            # vice versa.
-            contained = False
-            for illegal in illegal_words:
-                if clue in illegal or illegal in clue:
-                    contained = True
-                    break
-            if contained:
+            if clue_index not in legal:
+                legal[clue_index] = self.is_legal(clue, illegal_words)
+            if not legal[clue_index]:
                 continue
-            # Calculate the cosine similarity of this clue with all of the
-            # positive, negative and veto words.
-            clue_vector = self.model.syn0norm[clue_index]
-            clue_cosine = np.dot(clue_vectors[:, np.newaxis], clue_vector)
-            neg_cosine = np.dot(neg_vectors[:, np.newaxis], clue_vector)
-            veto_cosine = np.dot(veto_vectors[:, np.newaxis], clue_vector)
             # Is this closer to all of the positive words than our previous best?
-            min_clue_cosine = np.min(clue_cosine)
+            min_clue_cosine = min_clue_cosines[i]
             if min_clue_cosine < max_min_cosine:
                 continue
             # Are all positive words more similar than any negative words?
-            if list(neg_words):
-                max_neg_cosine = np.max(neg_cosine)
+            if neg_words:
+                max_neg_cosine = max_neg_cosines[i]
                 if max_neg_cosine >= min_clue_cosine:
                     # A negative word is likely to be selected before all the
                     # positive words.
                     if verbose >= 3:
-                        neg_word = neg_words[np.argmax(neg_cosine)]
+                        neg_word = neg_words[np.argmax(neg_cosines[i])]
                         print('neg word {0} is a distractor (cosine={1:.4f})'
                               .format(neg_word, max_neg_cosine))
                     continue
             # Is this word too similar to any of the veto words?
-            if list(veto_words):
-                max_veto_cosine = np.max(veto_cosine)
+            if veto_words:
+                max_veto_cosine = max_veto_cosines[i]
                 if max_veto_cosine >= min_clue_cosine - veto_margin:
                     # A veto word is too likely to be selected before all the
                     # positive words.
                     if verbose >= 2:
-                        veto_word = veto_words[np.argmax(veto_cosine)]
+                        veto_word = veto_words[np.argmax(veto_cosines[i])]
                         print('veto word {0} is a distractor (cosine={1:.4f})'
                               .format(veto_word, max_veto_cosine))
                     continue
@@ -138,13 +246,29 @@ class WordEmbedding(object):
             max_min_cosine = min_clue_cosine
             best_clue = clue
             if verbose >= 1:
-                words = [w.upper() for w in clue_words]
+                words = [w.upper() for w in self.get_words(clue_words)]
                 print('{0} = {1} (min_cosine={2:.4f})'
                       .format('+'.join(words), clue, min_clue_cosine))
 
         return best_clue, max_min_cosine
 
 
+    def is_legal(self, clue, illegal_words):
+        """Is clue allowed on a board with these words?
+        """
+        # Ignore clues with the same stem as an illegal clue.
+        clue_stem = self.get_stem(clue)
+        for illegal in illegal_words:
+            if self.get_stem(illegal) == clue_stem:
+                return False
+        # Ignore clues that are contained within an illegal clue or
+        # vice versa.
+        for illegal in illegal_words:
+            if clue in illegal or illegal in clue:
+                return False
+        return True
+
+
     def get_clusters_kmeans(self, words):
         """Use the KMeans algorithm to find word clusters.
         """
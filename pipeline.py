@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import articles
+import create_corpus_index
+import fetch_corpus_text
+import learn
+import mapped_corpus
+import metrics
+import preprocess_corpus
+import util
+from config import config
+
+# Per-word stages in the order they must run.
+stages = ('index', 'fetch', 'preprocess')
+
+# Files smaller than this are identified by a hash of their contents.
+# Larger files are identified by their size and modification time.
+max_hash_size = 1 << 24
+
+
+def file_signature(name):
+    """Return a string that changes whenever a file changes, or None.
+    """
+    if not os.path.exists(name):
+        return None
+    size = os.path.getsize(name)
+    if size > max_hash_size:
+        return '{0}:{1:.6f}'.format(size, os.path.getmtime(name))
+    with open(name, 'rb') as f_in:
+        return hashlib.sha1(f_in.read()).hexdigest()
+
+
+def get_signature(*parts):
+    """Combine JSON-serializable parts into a single signature.
+    """
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def get_inputs(stage, word, options):
+    """Return the signature of everything a stage depends on for a word.
+    """
+    index_name, articles_name, manifest_name = articles.get_names(word)
+    if stage == 'index':
+        return get_signature(word, options['index_size'])
+    elif stage == 'fetch':
+        # The min_size is not an input since fetching resumes from the
+        # articles already fetched (see is_complete).
+        return get_signature(file_signature(index_name))
+    elif stage == 'preprocess':
+        fetched = file_signature(manifest_name) or file_signature(articles_name)
+        return get_signature(fetched, file_signature(config.word_list))
+    raise ValueError('Invalid stage {0}.'.format(stage))
+
+
+def get_outputs(stage, word):
+    """Return the list of files that a stage creates for a word.
+    """
+    index_name, articles_name, manifest_name = articles.get_names(word)
+    if stage == 'index':
+        return [index_name]
+    elif stage == 'fetch':
+        if os.path.exists(manifest_name) or not os.path.exists(articles_name):
+            return [manifest_name]
+        # Articles fetched before manifests were introduced.
+        return [articles_name]
+    elif stage == 'preprocess':
+        return preprocess_corpus.get_names(word)
+    raise ValueError('Invalid stage {0}.'.format(stage))
+
+
+def is_complete(stage, word, options):
+    """Are all of the outputs of a stage for a word present and complete?
+    """
+    if not all([os.path.exists(name) for name in get_outputs(stage, word)]):
+        return False
+    if stage == 'fetch':
+        manifest = articles.load_manifest(articles.get_names(word)[2])
+        if (manifest is not None and
+                manifest['chars'] < options['min_size'] and
+                not manifest['exhausted']):
+            return False
+    return True
+
+
+def remove_outputs(stage, word):
+    """Remove stale outputs so that a stage starts again from scratch.
+    """
+    index_name, articles_name, manifest_name = articles.get_names(word)
+    names = list(get_outputs(stage, word))
+    if stage == 'index':
+        names.append(os.path.join(config.corpus_directory,
+                                  config.template['crawl'].format(word)))
+    elif stage == 'fetch':
+        names.extend([articles_name, manifest_name])
+    for name in names:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def run_stage(stage, word, inputs, options):
+    """Run one stage for one word in a worker process.
+
+    Returns a dictionary describing the outcome. Exceptions are caught and
+    reported so that a failure only affects this word.
+    """
+    start = time.time()
+    result = dict(stage=stage, word=word, inputs=inputs, error=None)
+    try:
+        if stage == 'index':
+            create_corpus_index.site_options.update(options['site'])
+            message, _, _ = create_corpus_index.index_word(
+                word, options['index_size'])
+            if not os.path.exists(get_outputs(stage, word)[0]):
+                result['error'] = message
+            result['message'] = message
+        elif stage == 'fetch':
+            fetch_corpus_text.store_root = options['store']
+            fetch_corpus_text.fetcher_options.update(options['fetcher'])
+            _, _, num_articles, size = fetch_corpus_text.fetch(
+                word, options['min_size'])
+            result['message'] = 'Fetched {0} new articles, {1} chars.'.format(
+                num_articles, size)
+            # Requests that failed leave the word short of text without
+            # marking it as exhausted, so it must be retried by a later run.
+            manifest = articles.load_manifest(articles.get_names(word)[2])
+            if (manifest is not None and size < options['min_size'] and
+                    not manifest['exhausted']):
+                result['error'] = ('Only fetched {0} chars after errors, rerun '
+                                   'to retry.'.format(size))
+        elif stage == 'preprocess':
+            _, compound, freq_keys = preprocess_corpus.read_word_list()
+            stats = preprocess_corpus.preprocess(word, compound, freq_keys)
+            result['message'] = 'Preprocessed {0} sentences, {1} words.'.format(
+                stats['num_sentences'], stats['num_words'])
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['start'], result['stop'] = start, time.time()
+    return result
+
+
+def load_state(name):
+    try:
+        with open(name, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_state(state, name):
+    tmp_name = name + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    util.replace_file(tmp_name, name)
+
+
+class StageSummary(object):
+    """Track progress and throughput for one stage.
+    """
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.num_run, self.num_skipped, self.num_failed = 0, 0, 0
+        self.busy = 0.
+        self.first_start, self.last_stop = None, None
+
+    def add(self, result):
+        self.num_run += 1
+        if result['error'] is not None:
+            self.num_failed += 1
+        self.busy += result['stop'] - result['start']
+        if self.first_start is None or result['start'] < self.first_start:
+            self.first_start = result['start']
+        if self.last_stop is None or result['stop'] > self.last_stop:
+            self.last_stop = result['stop']
+
+    @property
+    def num_done(self):
+        return self.num_run + self.num_skipped
+
+    @property
+    def wall(self):
+        if self.first_start is None:
+            return 0.
+        return self.last_stop - self.first_start
+
+    def rate(self):
+        return self.num_run / self.wall if self.wall > 0 else 0.
+
+    def __str__(self):
+        return ('{0:>10s} {1:5d} {2:5d} {3:5d} {4:5d} {5:9.1f} {6:9.1f} '
+                '{7:9.2f}'.format(self.name, self.num_done, self.num_run,
+                                  self.num_skipped, self.num_failed,
+                                  self.busy, self.wall, 60 * self.rate()))
+
+
+def build_corpora(words, num_passes, state, state_name, logger):
+    """Rebuild the shuffled training corpora and frequencies if necessary.
+    """
+    stats_names = [preprocess_corpus.get_names(word)[1] for word in words]
+    inputs = get_signature([file_signature(name) for name in stats_names],
+                           num_passes)
+    corpus_names = [learn.get_corpus_name(npass)
+                    for npass in range(1, num_passes + 1)]
+    previous = state.get('_corpus', {})
+    if (previous.get('inputs') == inputs and
+            all([os.path.exists(name) for name in corpus_names])):
+        logger.info('Training corpora are up to date.')
+        return
+
+    # Merge the statistics saved for each word.
+    all_stats = []
+    for name in stats_names:
+        with open(name, 'r') as f:
+            all_stats.append(json.load(f))
+    _, _, freq_keys = preprocess_corpus.read_word_list()
+    preprocess_corpus.save_freqs(all_stats, freq_keys, 'freqs.dat')
+    logger.info('Saved wordlist frequencies to freqs.dat and co-occurrences '
+                'to {0}'.format(preprocess_corpus.get_cooccur_name('freqs.dat')))
+
+    for corpus_name in corpus_names:
+        # Remove any stale corpus and its memory-mapped version.
+        root = mapped_corpus.get_root(corpus_name)
+        for name in [corpus_name] + list(mapped_corpus.get_names(root)):
+            if os.path.exists(name):
+                os.remove(name)
+    start = time.time()
+    learn.build_corpora(range(1, num_passes + 1), logger)
+    logger.info('Built {0} training corpora in {1:.1f}s.'.format(
+        num_passes, time.time() - start))
+
+    state['_corpus'] = dict(inputs=inputs, finished=time.time())
+    save_state(state, state_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Incrementally build the training corpus.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--state', type=str, default='pipeline.json',
+                        help='File used to track what has been built.')
+    parser.add_argument('--index-size', type=int,
+                        default=create_corpus_index.max_index_size,
+                        help='Target number of pages per word.')
+    parser.add_argument('--min-size', type=float, default=5e6,
+                        help='Number of characters of text to fetch per word.')
+    parser.add_argument('--nproc-index', type=int, default=4,
+                        help='Number of words to index concurrently.')
+    parser.add_argument('--nproc-fetch', type=int, default=20,
+                        help='Number of words to fetch concurrently.')
+    parser.add_argument('--nproc-preprocess', type=int, default=4,
+                        help='Number of words to preprocess concurrently.')
+    parser.add_argument('--api-url', type=str, default=config.api_url,
+                        help='URL of the mediawiki API to fetch from.')
+    parser.add_argument('--no-store', action='store_true',
+                        help='Save each word\'s articles to its own file.')
+    parser.add_argument('--passes', type=int, default=5,
+                        help='Number of shuffled training corpora to build.')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s : %(levelname)s : %(message)s',
+        level=logging.INFO)
+    logger = logging.getLogger('pipeline')
+
+    options = dict(
+        index_size=args.index_size, min_size=args.min_size,
+        site=dict(cache=os.path.join(config.corpus_directory, 'pages.db')),
+        store=None if args.no_store else os.path.join(
+            config.corpus_directory, 'store'),
+        fetcher=dict(api_url=args.api_url))
+
+    # Read the word list into memory and format using wikimedia conventions.
+    with open(config.word_list, 'r') as f:
+        words = [w.strip().capitalize() for w in f]
+    logger.info('Read {0} words from {1}.'.format(len(words), config.word_list))
+
+    if not os.path.isdir(config.corpus_directory):
+        os.mkdir(config.corpus_directory)
+
+    state = load_state(args.state)
+    summary = dict((stage, StageSummary(stage, len(words))) for stage in stages)
+    nproc = dict(index=args.nproc_index, fetch=args.nproc_fetch,
+                 preprocess=args.nproc_preprocess)
+    # Open the report of each stage before its pool is created, so that its
+    # workers record the words they process in that report.
+    reports, pools = {}, {}
+    for stage in stages:
+        reports[stage] = metrics.open_report(
+            metrics.get_report_name(stage), 'pipeline',
+            {stage: len(words)}, nproc=nproc[stage])
+        pools[stage] = multiprocessing.Pool(processes=nproc[stage])
+    results = queue.Queue()
+    num_pending = [0]
+
+    def submit(stage, word):
+        # Start a stage for a word unless its outputs are up to date, in
+        # which case move straight on to the next stage.
+        while stage is not None:
+            inputs = get_inputs(stage, word, options)
+            previous = state.get(word, {}).get(stage)
+            if previous is not None and previous['inputs'] == inputs:
+                if is_complete(stage, word, options):
+                    summary[stage].num_skipped += 1
+                    metrics.skip(stage, word, reports[stage])
+                    stage = next_stage(stage)
+                    continue
+            elif previous is not None:
+                # The inputs have changed since we last ran this stage.
+                remove_outputs(stage, word)
+            pools[stage].apply_async(
+                run_stage, (stage, word, inputs, options), callback=results.put)
+            num_pending[0] += 1
+            return
+
+    def next_stage(stage):
+        index = stages.index(stage) + 1
+        return stages[index] if index < len(stages) else None
+
+    for word in words:
+        submit(stages[0], word)
+
+    while num_pending[0] > 0:
+        # Use a timeout so that KeyboardInterrupt is handled promptly.
+        try:
+            result = results.get(timeout=1.)
+        except queue.Empty:
+            continue
+        num_pending[0] -= 1
+        stage, word = result['stage'], result['word']
+        summary[stage].add(result)
+        if result['error'] is None:
+            state.setdefault(word, {})[stage] = dict(
+                inputs=result['inputs'], finished=result['stop'],
+                elapsed=result['stop'] - result['start'])
+            save_state(state, args.state)
+            logger.info('[{0} {1}/{2} {3:.2f}/min] {4}: {5}'.format(
+                stage, summary[stage].num_done, len(words),
+                60 * summary[stage].rate(), word, result['message']))
+            if next_stage(stage) is not None:
+                submit(next_stage(stage), word)
+        else:
+            logger.error('[{0}] {1} failed:\n{2}'.format(
+                stage, word, result['error']))
+
+    for stage in stages:
+        pools[stage].close()
+        pools[stage].join()
+        metrics.close_report(reports[stage])
+
+    print('     STAGE  DONE   RUN  SKIP  FAIL   BUSY(s)   WALL(s)  WORDS/MIN')
+    for stage in stages:
+        print(summary[stage])
+
+    if any([summary[stage].num_failed for stage in stages]):
+        logger.error('Not building training corpora after failures.')
+        return -1
+    if args.passes > 0:
+        metrics.open_report(metrics.get_report_name('learn'), 'pipeline', {},
+                            passes=args.passes)
+        build_corpora(words, args.passes, state, args.state, logger)
+        metrics.close_report()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,46 @@ from __future__ import print_function, division
 import argparse
 import re
 
+import numpy as np
+
 import engine
 
 
+def benchmark(e, sizes, num_boards, max_exhaustive=13):
+    """Compare the computer spymaster with and without beam search.
+
+    For each board size, prints the number of groups tried and the time per
+    board for beam search, and for trying all groups when the first player
+    has at most max_exhaustive words, with how often both give the same
+    best clue and the ratio of their best scores.
+    """
+    print('SIZE  WORDS  BEAM GROUPS  MS/BOARD  ALL GROUPS  MS/BOARD  '
+          'SAME  RATIO')
+    for size in sizes:
+        states = []
+        for i in range(num_boards):
+            e.initialize_random_game(size)
+            states.append(e.get_state())
+        num_words = engine.get_layout(size)[0]
+        line = '{0:4d} {1:6d}'.format(size, num_words)
+        beam = e.get_clues(states, num_clues=1, max_exhaustive=0)
+        stats = e.batch_stats
+        line += ' {0:12.0f} {1:9.1f}'.format(
+            stats['num_groups'] / num_boards,
+            1e3 * stats['elapsed'] / num_boards)
+        if num_words <= max_exhaustive:
+            every = e.get_clues(states, num_clues=1,
+                                max_exhaustive=num_words)
+            stats = e.batch_stats
+            same = np.mean([b[:1] == a[:1] for b, a in zip(beam, every)])
+            ratio = np.mean([b[0][0] / a[0][0] for b, a in zip(beam, every)
+                             if a and b])
+            line += ' {0:11.0f} {1:9.1f} {2:5.2f} {3:6.3f}'.format(
+                stats['num_groups'] / num_boards,
+                1e3 * stats['elapsed'] / num_boards, same, ratio)
+        print(line)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Play the CodeNames game.',
@@ -19,20 +56,67 @@ def main():
                         help='Random seed for reproducible games.')
     parser.add_argument('--init', type=str, default=None,
                         help='Initialize words ASSASSIN;TEAM1;TEAM2;NEUTRAL')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='Print the best clue for this many random boards '
+                        'instead of playing.')
+    parser.add_argument('--size', type=int, default=5,
+                        help='Number of rows and columns on the board.')
+    parser.add_argument('--word-list', type=str, default=None,
+                        help='Use words from this file instead of the default '
+                        'word list.')
+    parser.add_argument('--benchmark', type=int, nargs='+', default=None,
+                        help='Time the computer spymaster on random boards of '
+                        'these sizes instead of playing.')
+    parser.add_argument('--beam-width', type=int, default=64,
+                        help='Number of groups of each size to try with beam '
+                        'search.')
     args = parser.parse_args()
 
     if not re.match('^[CH]{4}$', args.config):
         print('Invalid configuration. Try HHHH or CHCH.')
         return -1
 
+    sizes = args.benchmark or [args.size]
+    if min(sizes) < engine.min_board_size:
+        print('Invalid board size. Use at least {0}.'
+              .format(engine.min_board_size))
+        return -1
+
     d = dict(H='human', C='computer')
     spy1 = d[args.config[0]]
     team1 = d[args.config[1]]
     spy2 = d[args.config[2]]
     team2 = d[args.config[3]]
 
-    e = engine.GameEngine(seed=args.seed, expert=args.expert)
-    e.play_game(spy1, team1, spy2, team2, init=args.init)
+    e = engine.GameEngine(seed=args.seed, expert=args.expert,
+                          word_list=args.word_list, beam_width=args.beam_width)
+    if max(sizes) ** 2 > len(e.words):
+        print('Not enough words for a {0}x{0} board ({1} < {2}).'.format(
+            max(sizes), len(e.words), max(sizes) ** 2))
+        return -1
+
+    if args.benchmark:
+        benchmark(e, args.benchmark, max(args.batch, 10))
+        return
+
+    if args.batch > 0:
+        states = []
+        for i in range(args.batch):
+            e.initialize_random_game(args.size)
+            states.append(e.get_state())
+        for i, clues in enumerate(e.get_clues(states, num_clues=1)):
+            for score, clue, words in clues:
+                engine.say(u'{0:4d} {1:.3f} {2} = {3}'.format(
+                    i, score, ' + '.join([w.upper() for w in words]), clue))
+        stats = e.batch_stats
+        print('Found clues for {0} boards ({1} groups, {2} unique) in {3:.1f}s '
+              '= {4:.1f} boards/s'.format(
+                  stats['num_boards'], stats['num_groups'],
+                  stats['num_unique_groups'], stats['elapsed'],
+                  stats['boards_per_sec']))
+        return
+
+    e.play_game(spy1, team1, spy2, team2, init=args.init, size=args.size)
 
 
 if __name__ == '__main__':
@@ -2,99 +2,213 @@
 from __future__ import print_function, division
 
 import argparse
-import gzip
+import collections
+import json
 import os.path
 import re
 
+import numpy as np
+
 import nltk.tokenize
 
+import articles
+import codec
+import metrics
 from config import config
 
+heading = re.compile('=+ ([^=]+) =+\s*')
+punctuation = (',', ';', ':', '.', '!', '?', '-', '%', '&', '$',
+               '(', ')', '[', ']', '{', '}', '``', "''")
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Preprocess training corpus.',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-o', '--output', type=str, default='freqs.dat',
-                        help='Filename for saving word list frequencies.')
-    args = parser.parse_args()
 
-    heading = re.compile('=+ ([^=]+) =+\s*')
-    punctuation = (',', ';', ':', '.', '!', '?', '-', '%', '&', '$',
-                   '(', ')', '[', ']', '{', '}', '``', "''")
+def read_word_list():
+    """Read the word list and find any compound words.
 
-    # Read the word list and find any compound words since they must be
-    # treated as a single word during the learning step.
-    word_list = []
+    Compound words must be treated as a single word during the learning
+    step.  Returns the list of capitalized words, a dictionary that maps
+    each compound word to its joined form, and the list of keys used for
+    frequency counting.
+    """
+    word_list, freq_keys = [], []
     compound = {}
-    total_freq, cross_freq, corpus_stats = {}, {}, {}
     with open(config.word_list, 'r') as f:
         for word in f:
             word_list.append(word.strip().capitalize())
             word = word.strip().lower()
             if ' ' in word:
                 compound[word] = word.replace(' ', '_')
-                freq_key = compound[word]
+                freq_keys.append(compound[word])
             else:
-                freq_key = word
-            # Initialize frequency counters.
-            total_freq[freq_key] = cross_freq[freq_key] = 0
-            corpus_stats[freq_key] = (0, 0)
+                freq_keys.append(word)
+    return word_list, compound, freq_keys
+
+
+def get_cooccur_name(output):
+    """Return the filename of the co-occurrence matrix saved with output.
+    """
+    return os.path.splitext(output)[0] + '.cooccur.npy'
+
+
+def get_names(word):
+    """Return the (preprocessed, stats) filenames for a word.
+    """
+    return [os.path.join(config.corpus_directory,
+                         config.template[key].format(word))
+            for key in ('preprocess', 'stats')]
+
+
+def preprocess(word, compound, freq_keys):
+    """Preprocess the articles for one word.
+
+    Writes the preprocessed sentences and a JSON file of word list
+    frequency statistics for this word, and returns the statistics.  The
+    statistics include the number of sentences containing each pair of word
+    list words, as a sparse list of [word1, word2, count] with word1 <= word2.
+    """
+    with metrics.measure('preprocess', word) as measured:
+        stats = _preprocess(word, compound, freq_keys)
+        measured.update(sentences=stats['num_sentences'],
+                        words=stats['num_words'])
+    return stats
+
+
+def _preprocess(word, compound, freq_keys):
+    freq_key = word.lower().replace(' ', '_')
+    out_name, stats_name = get_names(word)
+    total_freq = dict((w, 0) for w in freq_keys)
+    cross_freq = dict((w, 0) for w in freq_keys)
+    num_sentences, num_words = 0, 0
+    # Number of sentences containing each set of word list words.
+    groups = collections.Counter()
+
+    # Read all of this word's articles into memory.
+    content = articles.read_text(word)
+    # Remove headings.
+    content = re.sub(heading, '', content)
+
+    with codec.open_file(out_name, 'wb') as f_out:
+        # Loop over sentences.
+        for sentence in nltk.tokenize.sent_tokenize(content):
+            words = []
+            for token in nltk.tokenize.word_tokenize(sentence):
+                # Ignore punctuation.
+                if token in punctuation:
+                    continue
+                words.append(token.lower())
+            line = ' '.join(words)
+            # Replace ' ' with '_' in compound words.
+            for w in compound:
+                line = line.replace(w, compound[w])
+            # Update wordlist frequencies.
+            present = set()
+            for w in line.split():
+                num_words += 1
+                if w in total_freq:
+                    total_freq[w] += 1
+                    present.add(w)
+                    if w != freq_key:
+                        cross_freq[w] += 1
+            if present:
+                groups[tuple(sorted(present))] += 1
+            num_sentences += 1
+            # Save this sentence to the preprocessed output.
+            f_out.write(line.encode(config.encoding) + '\n')
+
+    cooccur = collections.Counter()
+    for group, n in groups.items():
+        for i, w1 in enumerate(group):
+            for w2 in group[i:]:
+                cooccur[w1, w2] += n
+
+    stats = dict(
+        word=word, freq_key=freq_key, num_sentences=num_sentences,
+        num_words=num_words,
+        total_freq=dict((w, n) for w, n in total_freq.items() if n),
+        cross_freq=dict((w, n) for w, n in cross_freq.items() if n),
+        cooccur=[[w1, w2, n] for (w1, w2), n in sorted(cooccur.items())])
+    with open(stats_name, 'w') as f_out:
+        json.dump(stats, f_out)
+    return stats
+
+
+def save_freqs(all_stats, freq_keys, output):
+    """Merge the statistics for all words and save word list frequencies.
+
+    Also saves the symmetric matrix of the number of sentences containing
+    each pair of word list words, in the order of freq_keys, which has the
+    number of sentences containing each word on its diagonal.
+    """
+    total_freq = dict((w, 0) for w in freq_keys)
+    cross_freq = dict((w, 0) for w in freq_keys)
+    corpus_stats = dict((w, (0, 0)) for w in freq_keys)
+    index = dict((w, i) for i, w in enumerate(freq_keys))
+    cooccur = np.zeros((len(freq_keys), len(freq_keys)), dtype=np.int64)
+    num_missing = 0
+    for stats in all_stats:
+        if 'cooccur' not in stats:
+            num_missing += 1
+        elif stats['cooccur']:
+            w1, w2, n = zip(*stats['cooccur'])
+            rows = np.array([index[w] for w in w1])
+            cols = np.array([index[w] for w in w2])
+            np.add.at(cooccur, (rows, cols), n)
+            off_diagonal = rows != cols
+            np.add.at(cooccur, (cols[off_diagonal], rows[off_diagonal]),
+                      np.array(n)[off_diagonal])
+        for w, n in stats['total_freq'].items():
+            total_freq[w] += n
+        for w, n in stats['cross_freq'].items():
+            cross_freq[w] += n
+        corpus_stats[stats['freq_key']] = (
+            stats['num_sentences'], stats['num_words'])
+
+    # Save wordlist frequencies in decreasing order.
+    with open(output, 'w') as f_out:
+        print('WORD         TOTFREQ    XFREQ    NSENT    NWORD', file=f_out)
+        for w in sorted(total_freq, key=total_freq.get, reverse=True):
+            print('{0:11s} {1:8d} {2:8d} {3:8d} {4:8d}'.format(
+                w, total_freq[w], cross_freq[w], *corpus_stats[w]), file=f_out)
+
+    np.save(get_cooccur_name(output), cooccur)
+    if num_missing:
+        print('Co-occurrences are missing for {0} words preprocessed by an '
+              'older version.'.format(num_missing))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Preprocess training corpus.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', type=str, default='freqs.dat',
+                        help='Filename for saving word list frequencies.')
+    parser.add_argument('--report', type=str,
+                        default=metrics.get_report_name('preprocess'),
+                        help='Append timings of this run to this report.')
+    args = parser.parse_args()
+
+    word_list, compound, freq_keys = read_word_list()
     print('Wordlist contains {0} compound words:'.format(len(compound)))
     print(compound.keys())
 
+    num_words = sum([1 for word in word_list if articles.exists(word)])
+    metrics.open_report(args.report, 'preprocess_corpus',
+                        dict(preprocess=num_words))
+    all_stats = []
     for word in word_list:
 
-        freq_key = word.lower().replace(' ', '_')
-
-        in_name = os.path.join(config.corpus_directory, config.template['articles'].format(word))
-        if not os.path.exists(in_name):
-            print('Skipping missing file {0}'.format(in_name))
+        if not articles.exists(word):
+            print('Skipping missing articles for {0}'.format(word))
             continue
 
-        out_name = os.path.join(config.corpus_directory, config.template['preprocess'].format(word))
-        num_sentences, num_words = 0, 0
-
-        with gzip.open(in_name, 'rb') as f_in:
-            # Read the whole file into memory.
-            content = f_in.read().decode(config.encoding)
-            # Remove headings.
-            content = re.sub(heading, '', content)
-
-            with gzip.open(out_name, 'wb') as f_out:
-                # Loop over sentences.
-                for sentence in nltk.tokenize.sent_tokenize(content):
-                    words = []
-                    for token in nltk.tokenize.word_tokenize(sentence):
-                        # Ignore punctuation.
-                        if token in punctuation:
-                            continue
-                        words.append(token.lower())
-                    line = ' '.join(words)
-                    # Replace ' ' with '_' in compound words.
-                    for w in compound:
-                        line = line.replace(w, compound[w])
-                    # Update wordlist frequencies.
-                    for w in line.split():
-                        num_words += 1
-                        if w in total_freq:
-                            total_freq[w] += 1
-                            if w != freq_key:
-                                cross_freq[w] += 1
-                    num_sentences += 1
-                    # Save this sentence to the preprocessed output.
-                    f_out.write(line.encode(config.encoding) + '\n')
-
-        print(word, num_sentences, num_words)
-        corpus_stats[freq_key] = (num_sentences, num_words)
+        stats = preprocess(word, compound, freq_keys)
+        print(word, stats['num_sentences'], stats['num_words'])
+        all_stats.append(stats)
 
-    # Save wordlist frequencies in decreasing order.
-    with open(args.output, 'w') as f_out:
-        print('WORD         TOTFREQ    XFREQ    NSENT    NWORD', file=f_out)
-        for w in sorted(total_freq, key=total_freq.get, reverse=True):
-            print('{0:11s} {1:8d} {2:8d} {3:8d} {4:8d}'.format(
-                w, total_freq[w], cross_freq[w], *corpus_stats[w]), file=f_out)
-    print('Saved wordlist frequencies to {0}'.format(args.output))
+    with metrics.measure('freqs', args.output):
+        save_freqs(all_stats, freq_keys, args.output)
+    metrics.close_report()
+    print('Saved wordlist frequencies to {0} and co-occurrences to {1}'
+          .format(args.output, get_cooccur_name(args.output)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+
+import engine
+
+# The engine and the searched boards, which are shared with worker processes.
+_engine, _boards = None, None
+
+columns = ('veto_margin', 'num_search', 'gamma', 'found', 'words', 'score',
+           'margin', 'assassin_margin', 'ms_per_board')
+
+
+def get_boards(e, num_boards, num_search, batch_size=64):
+    """Prepare num_boards random boards for evaluating clues.
+
+    The closest num_search vocabulary words are found once for every group
+    of words on any board.  Since they are in decreasing order of similarity,
+    a smaller num_search uses the first entries only.  Returns the boards and
+    the elapsed time of this search.
+    """
+    boards = []
+    for i in range(num_boards):
+        e.initialize_random_game()
+        # Alternate the player giving the clue so both team sizes are used.
+        state = e.get_state()
+        state['player'] = i % 2
+        player_words, neg_words, veto_words = e.get_board_words(state)
+        boards.append(dict(
+            player_words=player_words, neg_words=neg_words,
+            veto_words=veto_words, groups=e.get_groups(player_words)))
+
+    start = time.time()
+    keys = sorted(set([key for board in boards
+                       for _, _, key in board['groups']]))
+    closest = dict(zip(keys, e.model.get_group_closest(
+        keys, num_search, batch_size)))
+    for board in boards:
+        board['groups'] = [(count, words, closest[key])
+                           for count, words, key in board['groups']]
+    return boards, time.time() - start
+
+
+def select_all(setting):
+    """Select the best clue for every group on every board with one setting.
+
+    Returns the setting, a list of the (count, clue, score, words) found for
+    each board, and the elapsed time.
+    """
+    veto_margin, num_search = setting
+    start = time.time()
+    selected = []
+    for board in _boards:
+        clues, legal = [], {}
+        for count, words, closest in board['groups']:
+            clue, score = _engine.model.select_clue(
+                clue_words=words, pos_words=board['player_words'],
+                neg_words=board['neg_words'], veto_words=board['veto_words'],
+                closest=closest[:num_search], veto_margin=veto_margin,
+                legal=legal)
+            if clue:
+                clues.append((count, clue, score, list(words)))
+        selected.append(clues)
+    return setting, selected, time.time() - start
+
+
+def get_margins(e, board, clue, words):
+    """Return how much closer a clue is to its words than to other words.
+
+    The margins are the smallest cosine similarity of the clue with its
+    words minus the largest with any opponent or neutral word, and minus the
+    similarity with the assassin.  A guesser is more likely to find all of
+    the words when these are large.
+    """
+    syn0norm = e.model.model.syn0norm
+    clue_vector = syn0norm[e.model.model.vocab[clue].index]
+    def get_cosines(words):
+        return np.dot(syn0norm[e.model.get_indices(words)], clue_vector)
+    min_cosine = get_cosines(words).min()
+    neg_words = board['neg_words']
+    margin = min_cosine - (
+        get_cosines(neg_words).max() if len(neg_words) else -1.)
+    assassin_margin = min_cosine - get_cosines(board['veto_words']).max()
+    return margin, assassin_margin
+
+
+def rank(selected, gamma):
+    """Return the best (count, clue, score, words) on each board, or None.
+
+    Scores are multiplied by count ** gamma, as in get_clues().
+    """
+    return [max(clues, key=lambda c: c[2] * c[0] ** gamma) if clues else None
+            for clues in selected]
+
+
+def evaluate(e, boards, best):
+    """Return quality proxies for the best clue on each board.
+    """
+    found, words, score, margin, assassin_margin = 0, 0, 0., 0., 0.
+    for board, clue in zip(boards, best):
+        if clue is None:
+            continue
+        count, clue, clue_score, clue_words = clue
+        margins = get_margins(e, board, clue, clue_words)
+        found += 1
+        words += count
+        score += clue_score
+        margin += margins[0]
+        assassin_margin += margins[1]
+    found, num_found = found / len(boards), max(found, 1)
+    return dict(found=found, words=words / num_found,
+                score=score / num_found, margin=margin / num_found,
+                assassin_margin=assassin_margin / num_found)
+
+
+def main():
+    global _engine, _boards
+    parser = argparse.ArgumentParser(
+        description='Sweep the clue selection parameters over random boards.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--boards', type=int, default=50,
+                        help='Number of random boards to evaluate.')
+    parser.add_argument('--seed', type=int, default=123,
+                        help='Random seed for the boards.')
+    parser.add_argument('--veto-margin', type=float, nargs='+',
+                        default=[0.1, 0.2, 0.3],
+                        help='Values of veto_margin to try.')
+    parser.add_argument('--num-search', type=int, nargs='+',
+                        default=[50, 100, 200],
+                        help='Values of num_search to try.')
+    parser.add_argument('--gamma', type=float, nargs='+',
+                        default=[0.5, 1.0, 1.5],
+                        help='Values of the gamma bonus to try.')
+    parser.add_argument('--nproc', type=int, default=None,
+                        help='Number of processes (default is one per CPU).')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Save the results to this CSV file.')
+    args = parser.parse_args()
+
+    _engine = engine.GameEngine(seed=args.seed)
+    _boards, elapsed = get_boards(
+        _engine, args.boards, max(args.num_search))
+    print('Searched {0} boards in {1:.1f}s ({2:.1f} ms/board).'.format(
+        args.boards, elapsed, 1e3 * elapsed / args.boards))
+
+    # Selecting clues does not depend on gamma, so each worker handles one
+    # (veto_margin, num_search) setting and all gammas are evaluated here.
+    settings = list(itertools.product(args.veto_margin, args.num_search))
+    pool = multiprocessing.Pool(processes=args.nproc)
+    rows = []
+    for (veto_margin, num_search), selected, elapsed in pool.imap_unordered(
+            select_all, settings):
+        for gamma in args.gamma:
+            start = time.time()
+            best = rank(selected, gamma)
+            rank_elapsed = time.time() - start
+            row = evaluate(_engine, _boards, best)
+            row.update(veto_margin=veto_margin, num_search=num_search,
+                       gamma=gamma, ms_per_board=1e3 * (
+                           elapsed + rank_elapsed) / len(_boards))
+            rows.append(row)
+    pool.close()
+    pool.join()
+
+    rows.sort(key=lambda row: (row['veto_margin'], row['num_search'],
+                               row['gamma']))
+    print('VETO  SEARCH  GAMMA  FOUND  WORDS  SCORE  MARGIN  ASSASSIN  '
+          'MS/BOARD')
+    for row in rows:
+        print('{veto_margin:4.2f} {num_search:7d} {gamma:6.2f} {found:6.2f} '
+              '{words:6.2f} {score:6.3f} {margin:7.3f} {assassin_margin:9.3f} '
+              '{ms_per_board:9.1f}'.format(**row))
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            writer = csv.DictWriter(f_out, columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+from __future__ import print_function, division
+
+import os
+
+
+def replace_file(tmp_name, name):
+    """Atomically replace name with tmp_name.
+    """
+    try:
+        os.rename(tmp_name, name)
+    except OSError:
+        # Windows will not rename onto an existing file.
+        os.remove(name)
+        os.rename(tmp_name, name)
@@ -0,0 +1,251 @@
+from __future__ import print_function, division
+
+import json
+import os
+import random
+import sqlite3
+import time
+
+import metrics
+
+# Namespaces that can be identified from a title prefix, used by FakeSite.
+# https://en.wikipedia.org/wiki/Wikipedia:Namespace
+fake_namespaces = {
+    'Talk': 1, 'User': 2, 'Wikipedia': 4, 'File': 6, 'Template': 10,
+    'Help': 12, 'Category': 14, 'Portal': 100, 'Book': 108,
+}
+
+
+class WikiSite(object):
+    """Page metadata from a real wiki via pywikibot.
+
+    Every method takes and returns plain page titles so that results can be
+    cached and serialized.  Requests raise a subclass of Error on failure,
+    and TransientError for failures that are worth retrying.
+    """
+    def __init__(self, code='en', family='wikipedia'):
+        # Use no user config and ignore warnings.
+        os.environ['PYWIKIBOT2_NO_USER_CONFIG'] = '2'
+        import pywikibot
+        import pywikibot.data.api
+        self.pywikibot = pywikibot
+        self.site = pywikibot.Site(code, family)
+        self.Error = pywikibot.Error
+        self.TransientError = (pywikibot.data.api.APIError,
+                               pywikibot.exceptions.ServerError,
+                               pywikibot.exceptions.TimeoutError)
+
+    def normalize(self, title):
+        """Return the canonical form of title and its namespace number.
+
+        This does not make any request.
+        """
+        page = self.pywikibot.Page(self.site, title)
+        return page.title(), page.namespace()
+
+    def is_disambig(self, title):
+        metrics.count('requests')
+        return self.pywikibot.Page(self.site, title).isDisambig()
+
+    def linked(self, title, total):
+        metrics.count('requests')
+        page = self.pywikibot.Page(self.site, title)
+        return [p.title() for p in page.linkedPages(total=total)]
+
+    def references(self, title, total):
+        metrics.count('requests')
+        page = self.pywikibot.Page(self.site, title)
+        return [p.title() for p in page.getReferences(total=total)]
+
+    def search(self, word, total):
+        metrics.count('requests')
+        # Only include results in the Main namespace.
+        results = self.site.search(
+            searchstring=word, where='text', namespaces=[0], total=total)
+        return [p.title() for p in results]
+
+
+class FakeSiteError(Exception):
+    pass
+
+
+class FakeSiteTimeout(FakeSiteError):
+    pass
+
+
+class FakeSite(object):
+    """An in-memory wiki for testing the crawler without any network access.
+
+    The pages dictionary maps each title to a dictionary with optional
+    'links' and 'refs' lists of titles, a 'disambig' flag and an 'error'
+    message that every request for the page fails with.  The searches
+    dictionary maps a search word to a list of result titles.  Requests
+    fail with FakeSiteTimeout at the given rate, and are counted in
+    num_requests.
+    """
+    Error = FakeSiteError
+    TransientError = FakeSiteTimeout
+
+    def __init__(self, pages, searches=None, fail_rate=0., seed=None):
+        self.pages = pages
+        self.searches = searches or {}
+        self.fail_rate = fail_rate
+        self.generator = random.Random(seed)
+        self.num_requests = 0
+
+    @classmethod
+    def load(cls, name, **kwargs):
+        """Create a fake site from a JSON file with pages and searches.
+        """
+        with open(name, 'r') as f:
+            data = json.load(f)
+        return cls(data['pages'], data.get('searches'), **kwargs)
+
+    def _request(self, title=None):
+        self.num_requests += 1
+        metrics.count('requests')
+        if self.generator.random() < self.fail_rate:
+            raise FakeSiteTimeout('Simulated request failure.')
+        error = self.pages.get(title, {}).get('error')
+        if error:
+            raise FakeSiteError(error)
+
+    def normalize(self, title):
+        if isinstance(title, bytes):
+            title = title.decode('utf8')
+        title = title[:1].upper() + title[1:]
+        prefix = title.split(':', 1)[0] if ':' in title else ''
+        return title, fake_namespaces.get(prefix, 0)
+
+    def is_disambig(self, title):
+        self._request(title)
+        return self.pages.get(title, {}).get('disambig', False)
+
+    def linked(self, title, total):
+        self._request(title)
+        return self.pages.get(title, {}).get('links', [])[:total]
+
+    def references(self, title, total):
+        self._request(title)
+        return self.pages.get(title, {}).get('refs', [])[:total]
+
+    def search(self, word, total):
+        self._request()
+        return self.searches.get(word, [])[:total]
+
+
+class PageCache(object):
+    """Persistent cache of page metadata shared by all crawler processes.
+
+    Entries are stored in an sqlite database and expire after ttl seconds.
+    Once the cache holds more than max_entries, the least recently fetched
+    entries are evicted.
+    """
+    def __init__(self, name, ttl=30 * 86400., max_entries=2000000,
+                 evict_interval=10000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self.num_puts = 0
+        self._db = None
+
+    @property
+    def db(self):
+        # Connect on first use so that each process has its own connection.
+        if self._db is None:
+            self._db = sqlite3.connect(self.name, timeout=300.)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS pages (kind TEXT, title TEXT, '
+                'total INTEGER, value TEXT, fetched REAL, '
+                'PRIMARY KEY (kind, title))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS pages_fetched ON pages (fetched)')
+            self._db.commit()
+        return self._db
+
+    def get(self, kind, title, total=0):
+        """Return the cached value or None.
+
+        A cached list fetched with a smaller total than requested is only
+        used if it was complete, i.e. shorter than its own total.
+        """
+        row = self.db.execute(
+            'SELECT total, value, fetched FROM pages WHERE kind=? AND title=?',
+            (kind, title)).fetchone()
+        if row is not None:
+            cached_total, value, fetched = row
+            if time.time() - fetched < self.ttl:
+                value = json.loads(value)
+                if total <= 0:
+                    self.hits += 1
+                    return value
+                if cached_total >= total or len(value) < cached_total:
+                    self.hits += 1
+                    return value[:total]
+        self.misses += 1
+        return None
+
+    def put(self, kind, title, value, total=0):
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                (kind, title, total, json.dumps(value), time.time()))
+        self.num_puts += 1
+        if self.num_puts % self.evict_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries and enforce max_entries.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM pages WHERE fetched < ?',
+                            (time.time() - self.ttl,))
+            count = self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    'DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages '
+                    'ORDER BY fetched LIMIT ?)', (count - self.max_entries,))
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+
+class CachedSite(object):
+    """Wrap a site so that requests are answered from a PageCache if possible.
+    """
+    def __init__(self, site, cache):
+        self.site = site
+        self.cache = cache
+        self.Error = site.Error
+        self.TransientError = site.TransientError
+
+    def normalize(self, title):
+        return self.site.normalize(title)
+
+    def _cached(self, kind, key, total, fetch):
+        value = self.cache.get(kind, key, total)
+        if value is None:
+            value = fetch()
+            self.cache.put(kind, key, value, total)
+        return value
+
+    def is_disambig(self, title):
+        return self._cached('disambig', title, 0,
+                            lambda: self.site.is_disambig(title))
+
+    def linked(self, title, total):
+        return self._cached('linked', title, total,
+                            lambda: self.site.linked(title, total))
+
+    def references(self, title, total):
+        return self._cached('references', title, total,
+                            lambda: self.site.references(title, total))
+
+    def search(self, word, total):
+        return self._cached('search', word, total,
+                            lambda: self.site.search(word, total))